@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+
+MAX_BYTES = 1024 * 1024 * 1024
+TTL = 30 * 24 * 60 * 60
+
+
+class CacheMissError(Exception):
+    pass
+
+
+class ResponseCache:
+    """Disk cache of streamed completions, keyed by a hash of the request.
+
+    Each entry is a json-lines file: a header with its creation time, then
+    one chunk per line, so a hit can be streamed again chunk by chunk. Least
+    recently used entries are evicted once the cache outgrows `max_bytes`.
+    With `replay_only`, a miss raises instead of calling the API.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        max_bytes: int = MAX_BYTES,
+        ttl: float = TTL,
+        replay_only: bool = False,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.replay_only = replay_only
+        self.hits = 0
+        self.misses = 0
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(model: str, temperature: float, messages, tools: List[Any]) -> str:
+        payload = json.dumps(
+            {
+                "model": model,
+                "temperature": temperature,
+                "messages": list(messages),
+                "tools": tools,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.jsonl")
+
+    def get(self, key: str) -> Optional[List[ChatCompletionChunk]]:
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                header = json.loads(f.readline())
+                if time.time() - header["created"] > self.ttl:
+                    chunks = None
+                else:
+                    chunks = [ChatCompletionChunk.model_validate_json(l) for l in f]
+        except FileNotFoundError:
+            chunks = None
+
+        with self._lock:
+            if chunks is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if chunks is None:
+            if self.replay_only:
+                raise CacheMissError(f"No cached response for {key}")
+            return None
+        # The modification time is the last use, for the LRU eviction
+        os.utime(path)
+        return chunks
+
+    def put(self, key: str, chunks: List[ChatCompletionChunk]) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"created": time.time()}) + "\n")
+            for chunk in chunks:
+                f.write(chunk.model_dump_json() + "\n")
+        size = os.path.getsize(tmp_path)
+
+        # Replaced under the lock, so that the size it overwrites is right
+        with self._lock:
+            try:
+                replaced_size = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(tmp_path, path)
+            if self._size is None:
+                self._size = sum(e.stat().st_size for e in self._entries())
+            else:
+                self._size += size - replaced_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self) -> List[os.DirEntry]:
+        return [e for e in os.scandir(self.directory) if e.name.endswith(".jsonl")]
+
+    def _evict(self) -> None:
+        entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime)
+        size = sum(e.stat().st_size for e in entries)
+        for entry in entries:
+            if size <= self.max_bytes * 0.9:
+                break
+            size -= entry.stat().st_size
+            os.remove(entry.path)
+        self._size = size
+
+    def record(
+        self, key: str, chunks: Iterator[ChatCompletionChunk]
+    ) -> Iterator[ChatCompletionChunk]:
+        """Streams `chunks` through, caching them if they are read to the end."""
+        collected = []
+        try:
+            for chunk in chunks:
+                collected.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            # Closed before the end, ie, aborted: closes the response too
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            raise
+        self.put(key, collected)
+
+    async def arecord(
+        self, key: str, chunks: AsyncIterator[ChatCompletionChunk]
+    ) -> AsyncIterator[ChatCompletionChunk]:
+        collected = []
+        try:
+            async for chunk in chunks:
+                collected.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                await close()
+            raise
+        self.put(key, collected)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+async def areplay(
+    chunks: List[ChatCompletionChunk],
+) -> AsyncIterator[ChatCompletionChunk]:
+    for chunk in chunks:
+        yield chunk
+
+
+def cache_from_env() -> Optional[ResponseCache]:
+    """Enabled by setting LLM_CACHE_DIR. LLM_CACHE_REPLAY=1 forbids misses."""
+    directory = os.environ.get("LLM_CACHE_DIR")
+    if not directory:
+        return None
+    return ResponseCache(
+        os.path.expanduser(directory),
+        max_bytes=int(os.environ.get("LLM_CACHE_MAX_BYTES", MAX_BYTES)),
+        ttl=float(os.environ.get("LLM_CACHE_TTL", TTL)),
+        replay_only=os.environ.get("LLM_CACHE_REPLAY") == "1",
+    )
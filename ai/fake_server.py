@@ -0,0 +1,118 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, cast
+
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+from ai.cache import ResponseCache
+
+# The chunks to stream for a request body, or None for a 404
+Responses = Callable[[Dict[str, Any]], Optional[List[ChatCompletionChunk]]]
+
+
+class FakeServer:
+    """A local chat completions API that replays canned chunk streams, ie, to
+    run the workflows without paying for them.
+
+    Point OPENAI_BASE_URL at `url` before importing ai.llm, since its sync
+    client reads it then. `requests` are the bodies that it received.
+    """
+
+    def __init__(
+        self,
+        responses: Responses,
+        *,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        delay: float = 0.0,
+    ):
+        self.responses = responses
+        self.delay = delay
+        self.requests: List[Dict[str, Any]] = []
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        # The address of an AF_INET server, so its host is a str
+        host = cast(str, self._server.server_address[0])
+        return f"http://{host}:{self._server.server_address[1]}/v1"
+
+    def _handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args: Any) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.requests.append(body)
+                chunks = server.responses(body)
+                if chunks is None:
+                    self.send_error(404, "No canned response")
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                try:
+                    for chunk in chunks:
+                        self.wfile.write(
+                            f"data: {chunk.model_dump_json()}\n\n".encode()
+                        )
+                        self.wfile.flush()
+                        time.sleep(server.delay)
+                    self.wfile.write(b"data: [DONE]\n\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client closed the stream, ie, it was aborted
+                    pass
+
+        return Handler
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def start(self) -> "FakeServer":
+        """Serves in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeServer":
+        return self.start()
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+
+def replay_cache(cache: ResponseCache) -> Responses:
+    """The responses recorded in `cache`, ie, with LLM_CACHE_DIR."""
+
+    def responses(body: Dict[str, Any]) -> Optional[List[ChatCompletionChunk]]:
+        key = cache.key(
+            body["model"], body["temperature"], body["messages"], body.get("tools", [])
+        )
+        return cache.get(key)
+
+    return responses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cache_dir")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeServer(
+        replay_cache(ResponseCache(args.cache_dir)), port=args.port, delay=args.delay
+    )
+    print(f"OPENAI_BASE_URL={server.url}")
+    server.serve_forever()
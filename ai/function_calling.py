@@ -7,6 +7,7 @@ from pydantic import BaseModel, ValidationError
 
 from ai import llm
 from ai.llm import RawFunctionParams
+from ai.validators import StreamAborted
 from utils.state import Conversation
 from utils.io import print_system
 
@@ -61,7 +62,14 @@ class Function(ABC, Generic[Parameters]):
     def execute(cls, conversation: Conversation, max_tries: int = 2) -> List[Parameters]:
         tries = 1
         while tries <= max_tries:
-            generation = llm.stream_next(conversation, tools=[cls.tool()])
+            try:
+                generation = llm.stream_next(conversation, tools=[cls.tool()])
+            except StreamAborted as e:
+                # ie, malformed arguments
+                print_system(e)
+                conversation.add_user(f"Wrong output :: {e}")
+                tries += 1
+                continue
             print_system(generation)
             if isinstance(generation, RawFunctionParams):
                 conversation.add_raw_tool(generation)
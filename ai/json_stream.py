@@ -0,0 +1,89 @@
+import json
+from typing import Any, Callable, Dict, List, Optional
+
+
+class MalformedJSONError(ValueError):
+    pass
+
+
+WHITESPACE = " \t\r\n"
+CLOSING = {"}": "{", "]": "["}
+
+
+class JSONObjectStream:
+    """Parses a stream of JSON objects, ie, the arguments of a tool call, as
+    its deltas arrive, calling `on_object` with each one as soon as it's
+    closed.
+
+    Each character is scanned once, to find where the objects end, and each
+    object is decoded once. `\\'`, which isn't valid JSON but the models
+    write it, is kept as is.
+    """
+
+    def __init__(self, on_object: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.on_object = on_object
+        self.objects: List[Dict[str, Any]] = []
+        self._buffer: List[str] = []
+        # The open brackets of the current object
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escaped = False
+        self._position = 0
+
+    def feed(self, delta: str) -> None:
+        """Raises MalformedJSONError as soon as the stream can't be JSON."""
+        for char in delta:
+            self._position += 1
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                    if char == "'":
+                        # The backslash escaped, so that it's decoded as \'
+                        self._buffer.append("\\")
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                self._buffer.append(char)
+                continue
+
+            if char in WHITESPACE:
+                if self._stack:
+                    self._buffer.append(char)
+                continue
+            if not self._stack and char != "{":
+                raise MalformedJSONError(
+                    f"Expected an object at {self._position}, found {char!r}"
+                )
+            if char in "{[":
+                self._stack.append(char)
+            elif char in CLOSING:
+                if self._stack.pop() != CLOSING[char]:
+                    raise MalformedJSONError(f"Unexpected {char!r} at {self._position}")
+            elif char == '"':
+                self._in_string = True
+            self._buffer.append(char)
+            if not self._stack:
+                self._emit()
+
+    def _emit(self) -> None:
+        raw = "".join(self._buffer)
+        self._buffer = []
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError as e:
+            raise MalformedJSONError(
+                f"{e.msg} in the object that ends at {self._position}"
+            )
+        self.objects.append(value)
+        if self.on_object is not None:
+            self.on_object(value)
+
+    def close(self) -> List[Dict[str, Any]]:
+        """The objects of the whole stream. Raises MalformedJSONError if it
+        ended in the middle of one, or without any."""
+        if self._stack or self._in_string:
+            raise MalformedJSONError(f"Unexpected end at {self._position}")
+        if not self.objects:
+            raise MalformedJSONError("Expected an object, found nothing")
+        return self.objects
@@ -1,21 +1,63 @@
-from typing import Any, Dict, List, Optional, Union, Tuple
+from contextlib import nullcontext
+from typing import (
+    Any,
+    AsyncContextManager,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Union,
+    Tuple,
+)
 
 import json
 from pydantic import BaseModel
-from openai import OpenAI, Stream
+from openai import AsyncOpenAI, OpenAI
 from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
 from openai.types.chat.chat_completion_tool_param import ChatCompletionToolParam
 from openai.types.completion_usage import CompletionUsage
 
+from ai.cache import areplay, cache_from_env
+from ai.json_stream import JSONObjectStream, MalformedJSONError
+from ai.rate_limit import RateLimiter
+from ai.tokens import count_tokens
+from ai.usage import OCost, ledger, prefixes
+from ai.validators import StreamAborted, StreamValidator, check_delta
 from utils.io import print_assistant, print_system
+from utils.state import Conversation
 
 
 client = OpenAI()
+# Created lazily, so that it binds to OPENAI_BASE_URL at first use
+async_client: Optional[AsyncOpenAI] = None
 
 
 MODEL = "gpt-4o"
 TEMPERATURE = 0.0
 
+CONTEXT_WINDOWS = {"gpt-4o": 128_000, "gpt-4o-mini": 128_000}
+DEFAULT_CONTEXT_WINDOW = 128_000
+# Fraction of the context window for the prompt, the rest is for the output
+CONTEXT_TARGET = 0.75
+
+MAX_CONCURRENT_REQUESTS = 20
+REQUESTS_PER_MINUTE = 5_000
+TOKENS_PER_MINUTE = 450_000
+
+# Set LLM_CACHE_DIR to reuse identical completions across runs
+cache = cache_from_env()
+
+limiter = RateLimiter(
+    max_concurrency=MAX_CONCURRENT_REQUESTS,
+    requests_per_minute=REQUESTS_PER_MINUTE,
+    tokens_per_minute=TOKENS_PER_MINUTE,
+)
+
 
 class RawFunctionParams(BaseModel):
     id: str
@@ -26,21 +68,74 @@ class RawFunctionParams(BaseModel):
         return json.dumps(self.dict(), indent=2)
 
 
-class OCost(BaseModel):
-    PRICE_PER_1K_INPUT: float = 0.005
-    PRICE_PER_1K_OUTPUT: float = 0.015
+# Paid usage of this process. The ledger breaks it down by model, app, etc.
+model_cost = OCost()
+
 
-    input: int = 0
-    output: int = 0
+def _record_usage(
+    model: Optional[str], messages, usage: CompletionUsage, *, from_cache: bool
+) -> None:
+    ledger.record(
+        model or MODEL,
+        usage,
+        from_cache=from_cache,
+        cache_eligible_input=prefixes.observe(messages),
+    )
+    if not from_cache:
+        model_cost.add(usage)
 
-    def get(self) -> float:
-        return (
-            self.PRICE_PER_1K_INPUT * self.input / 1_000
-            + self.PRICE_PER_1K_OUTPUT * self.output / 1_000
-        )
 
+def _estimate_tokens(messages) -> int:
+    if isinstance(messages, Conversation):
+        return messages.count_tokens()
+    return sum(count_tokens(m["content"]) for m in messages if m.get("content"))
 
-model_cost = OCost()
+
+def _partial_usage(messages, text: str) -> CompletionUsage:
+    """Estimated, for a stream that was aborted before its usage chunk."""
+    prompt_tokens = _estimate_tokens(messages)
+    completion_tokens = count_tokens(text)
+    return CompletionUsage(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
+
+
+def _fit_context(messages, model: Optional[str]):
+    """Compacts long conversations so that they fit in the model's window."""
+    if not isinstance(messages, Conversation):
+        return messages
+    window = CONTEXT_WINDOWS.get(model or MODEL, DEFAULT_CONTEXT_WINDOW)
+    budget = int(window * CONTEXT_TARGET)
+    if messages.count_tokens() <= budget:
+        return messages
+    compacted = messages.compact(budget)
+    print_system(
+        f"Compacted conversation :: {messages.count_tokens()} -> "
+        f"{compacted.count_tokens()} tokens"
+    )
+    return compacted
+
+
+def _cached(
+    messages,
+    model: Optional[str],
+    temperature: Optional[float],
+    tools: List[ChatCompletionToolParam],
+) -> Optional[List[ChatCompletionChunk]]:
+    """The chunks of an identical completion, if it's cached. Checked before
+    taking from the limits of the API, which replays don't count against."""
+    if cache is None:
+        return None
+    return cache.get(
+        cache.key(
+            model or MODEL,
+            TEMPERATURE if temperature is None else temperature,
+            messages,
+            tools,
+        )
+    )
 
 
 def _generate(
@@ -48,14 +143,15 @@ def _generate(
     model: Optional[str] = None,
     temperature: Optional[float] = None,
     tools: List[ChatCompletionToolParam] = [],
-) -> Stream[ChatCompletionChunk]:
+) -> Iterator[ChatCompletionChunk]:
+    """Records the stream of chunks in the cache, if any."""
     if not model:
         model = MODEL
     if temperature is None:
         temperature = TEMPERATURE
 
     if tools:
-        return client.chat.completions.create(
+        response = client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
@@ -64,13 +160,76 @@ def _generate(
             tools=tools,
             tool_choice="auto",
         )
-    return client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-        stream=True,
-        stream_options={"include_usage": True},
+    else:
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+    if cache is not None:
+        return cache.record(cache.key(model, temperature, messages, tools), response)
+    return response
+
+
+def _record(
+    model: Optional[str],
+    messages,
+    estimated_tokens: int,
+    usage: CompletionUsage,
+    *,
+    from_cache: bool,
+) -> None:
+    if not from_cache:
+        limiter.record(estimated_tokens, usage.total_tokens)
+    _record_usage(model, messages, usage, from_cache=from_cache)
+
+
+def _first_chunk(response: Iterator[ChatCompletionChunk]) -> ChatCompletionChunk:
+    for chunk in response:
+        if chunk.choices and (
+            chunk.choices[0].delta.content is not None
+            or chunk.choices[0].delta.tool_calls is not None
+        ):
+            return chunk
+    raise ValueError("Empty response")
+
+
+Collector = Callable[
+    [ChatCompletionChunk, Iterator[ChatCompletionChunk]], Tuple[Any, CompletionUsage]
+]
+
+
+def _stream(
+    messages,
+    model: Optional[str],
+    temperature: Optional[float],
+    tools: List[ChatCompletionToolParam],
+    collect: Collector,
+) -> Any:
+    """Streams a completion within the limits of `limiter`, and records its
+    usage, also when `collect` aborts it."""
+    messages = _fit_context(messages, model)
+    estimated_tokens = _estimate_tokens(messages)
+    cached_chunks = _cached(messages, model, temperature, tools)
+    from_cache = cached_chunks is not None
+    limit: ContextManager[None] = (
+        nullcontext() if from_cache else limiter.hold(estimated_tokens)
     )
+    with limit:
+        if cached_chunks is not None:
+            response: Iterator[ChatCompletionChunk] = iter(cached_chunks)
+        else:
+            response = _generate(messages, model, temperature, tools)
+        try:
+            output, usage = collect(_first_chunk(response), response)
+        except StreamAborted as e:
+            usage = _partial_usage(messages, e.text)
+            _record(model, messages, estimated_tokens, usage, from_cache=from_cache)
+            raise
+    _record(model, messages, estimated_tokens, usage, from_cache=from_cache)
+    return output
 
 
 def stream_next(
@@ -78,42 +237,34 @@ def stream_next(
     model: Optional[str] = None,
     temperature: Optional[float] = None,
     tools: List[ChatCompletionToolParam] = [],
+    on_arguments: Optional[Callable[[Dict[str, Any]], None]] = None,
 ) -> Union[str, RawFunctionParams]:
-    response = _generate(messages, model, temperature, tools)
-
-    first_chunk = next(response)
-    while (
-        first_chunk.choices[0].delta.content is None
-        and first_chunk.choices[0].delta.tool_calls is None
-    ):
-        first_chunk = next(response)
+    """`on_arguments` is called with each argument object of a tool call as
+    soon as it's streamed. Raises StreamAborted if they aren't JSON."""
 
-    if first_chunk.choices[0].delta.content is not None:
-        output, usage = _collect_text(first_chunk, response)
-    else:
-        output, usage = _collect_tool(first_chunk, response)
+    def collect(first_chunk, chunks):
+        if first_chunk.choices[0].delta.content is not None:
+            return _collect_text(first_chunk, chunks)
+        return _collect_tool(first_chunk, chunks, on_arguments)
 
-    return output
+    return _stream(messages, model, temperature, tools, collect)
 
 
 def stream_text(
     messages,
     model: Optional[str] = None,
     temperature: Optional[float] = None,
+    validators: Sequence[StreamValidator] = (),
 ) -> str:
-    response = _generate(messages, model, temperature, tools=[])
-
-    first_chunk = next(response)
-    while (
-        first_chunk.choices[0].delta.content is None
-        and first_chunk.choices[0].delta.tool_calls is None
-    ):
-        first_chunk = next(response)
-
-    assert first_chunk.choices[0].delta.content is not None
-
-    output, usage = _collect_text(first_chunk, response)
-    return output
+    """Raises StreamAborted if one of `validators` rejects the stream, which
+    is closed right away, and isn't cached."""
+    return _stream(
+        messages,
+        model,
+        temperature,
+        [],
+        lambda first_chunk, chunks: _collect_text(first_chunk, chunks, validators),
+    )
 
 
 def stream_function(
@@ -121,21 +272,16 @@ def stream_function(
     model: Optional[str] = None,
     temperature: Optional[float] = None,
     tools: List[ChatCompletionToolParam] = [],
+    on_arguments: Optional[Callable[[Dict[str, Any]], None]] = None,
 ) -> RawFunctionParams:
     assert len(tools) > 0
-    response = _generate(messages, model, temperature, tools)
-
-    first_chunk = next(response)
-    while (
-        first_chunk.choices[0].delta.content is None
-        and first_chunk.choices[0].delta.tool_calls is None
-    ):
-        first_chunk = next(response)
-
-    assert first_chunk.choices[0].delta.content is None
-
-    output, usage = _collect_tool(first_chunk, response)
-    return output
+    return _stream(
+        messages,
+        model,
+        temperature,
+        tools,
+        lambda first_chunk, chunks: _collect_tool(first_chunk, chunks, on_arguments),
+    )
 
 
 def stream(
@@ -146,25 +292,71 @@ def stream(
 
 
 def _collect_text(
-    first_chunk: ChatCompletionChunk, chunks: Stream[ChatCompletionChunk]
+    first_chunk: ChatCompletionChunk,
+    chunks: Iterator[ChatCompletionChunk],
+    validators: Sequence[StreamValidator] = (),
 ) -> Tuple[str, CompletionUsage]:
-    message = first_chunk.choices[0].delta.content or ""
+    assert first_chunk.choices[0].delta.content is not None
+    message = first_chunk.choices[0].delta.content
     usage = None
     print_assistant(message, end="", flush=True)
-    for chunk in chunks:
-        if chunk.usage:
-            usage = chunk.usage
-        if chunk.choices and chunk.choices[0].delta.content is not None:
-            message += chunk.choices[0].delta.content
-            print_assistant(chunk.choices[0].delta.content, end="", flush=True)
+    try:
+        check_delta(validators, message, message)
+        for chunk in chunks:
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                message += chunk.choices[0].delta.content
+                print_assistant(chunk.choices[0].delta.content, end="", flush=True)
+                check_delta(validators, chunk.choices[0].delta.content, message)
+    except StreamAborted as e:
+        print_assistant()
+        print_system(f"Aborted stream :: {e.reason}")
+        # Stops the generation, instead of paying for the rest of it
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+        raise
     print_assistant()
     assert usage
     return message, usage
 
 
+class _ToolArguments:
+    """The arguments of the tool calls of a stream, parsed as they arrive.
+    `on_arguments` is called with each object as soon as it's closed."""
+
+    def __init__(self, on_arguments: Optional[Callable[[Dict[str, Any]], None]]):
+        self.on_arguments = on_arguments
+        self.arguments: List[Dict[str, Any]] = []
+        self.index = 0
+        self.parser = JSONObjectStream(on_arguments)
+        # What was streamed, if it has to be reported
+        self.raw: List[str] = []
+
+    def feed(self, chunk: ChatCompletionChunk) -> None:
+        if not (chunk.choices and chunk.choices[0].delta.tool_calls):
+            return
+        tool_call = chunk.choices[0].delta.tool_calls[0]
+        if tool_call.index != self.index:
+            self.arguments.extend(self.parser.close())
+            self.index = tool_call.index
+            self.parser = JSONObjectStream(self.on_arguments)
+        if tool_call.function and tool_call.function.arguments:
+            self.raw.append(tool_call.function.arguments)
+            self.parser.feed(tool_call.function.arguments)
+
+    def close(self) -> List[Dict[str, Any]]:
+        self.arguments.extend(self.parser.close())
+        return self.arguments
+
+
 def _collect_tool(
-    first_chunk: ChatCompletionChunk, chunks: Stream[ChatCompletionChunk]
+    first_chunk: ChatCompletionChunk,
+    chunks: Iterator[ChatCompletionChunk],
+    on_arguments: Optional[Callable[[Dict[str, Any]], None]] = None,
 ) -> Tuple[RawFunctionParams, CompletionUsage]:
+    """Raises StreamAborted if the arguments aren't JSON objects."""
     assert first_chunk.choices[0].delta.tool_calls
     assert first_chunk.choices[0].delta.tool_calls[0].id
     assert first_chunk.choices[0].delta.tool_calls[0].function
@@ -173,26 +365,23 @@ def _collect_tool(
     tool_name = first_chunk.choices[0].delta.tool_calls[0].function.name
     usage = None
 
-    arguments = first_chunk.choices[0].delta.tool_calls[0].function.arguments or ""
-    print_assistant(".", end="", flush=True)
-    arguments_list = []
-    current_index = 0
-    for chunk in chunks:
-        if chunk.usage:
-            usage = chunk.usage
-        if chunk.choices and chunk.choices[0].delta.tool_calls:
-            if chunk.choices[0].delta.tool_calls[0].index != current_index:
-                arguments = _parse_args(arguments)
-                arguments_list.append(arguments)
-                current_index = chunk.choices[0].delta.tool_calls[0].index
-                arguments = ""
-            if chunk.choices[0].delta.tool_calls[0].function:
-                arguments += (
-                    chunk.choices[0].delta.tool_calls[0].function.arguments or ""
-                )
+    arguments = _ToolArguments(on_arguments)
+    try:
+        arguments.feed(first_chunk)
         print_assistant(".", end="", flush=True)
-    arguments = _parse_args(arguments)
-    arguments_list.append(arguments)
+        for chunk in chunks:
+            if chunk.usage:
+                usage = chunk.usage
+            arguments.feed(chunk)
+            print_assistant(".", end="", flush=True)
+        arguments_list = arguments.close()
+    except MalformedJSONError as e:
+        print_assistant()
+        print_system(f"Malformed arguments :: {e}")
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+        raise StreamAborted(type(e).__name__, str(e), "".join(arguments.raw))
     print_assistant()
 
     assert usage
@@ -202,26 +391,217 @@ def _collect_tool(
     )
 
 
-def _parse_args(args: str) -> Dict[str, Any]:
-    escaped_args = _escape_quotes(args)
+# Async variants. They share `limiter` with the sync ones, so any number of
+# them can be gathered.
+
+
+def get_async_client() -> AsyncOpenAI:
+    global async_client
+    if async_client is None:
+        async_client = AsyncOpenAI()
+    return async_client
+
+
+async def _agenerate(
+    messages,
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    tools: List[ChatCompletionToolParam] = [],
+) -> AsyncIterator[ChatCompletionChunk]:
+    if not model:
+        model = MODEL
+    if temperature is None:
+        temperature = TEMPERATURE
+
+    if tools:
+        response = await get_async_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+            tools=tools,
+            tool_choice="auto",
+        )
+    else:
+        response = await get_async_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+    if cache is not None:
+        return cache.arecord(cache.key(model, temperature, messages, tools), response)
+    return response
+
+
+async def _afirst_chunk(
+    response: AsyncIterator[ChatCompletionChunk],
+) -> ChatCompletionChunk:
+    async for chunk in response:
+        if chunk.choices and (
+            chunk.choices[0].delta.content is not None
+            or chunk.choices[0].delta.tool_calls is not None
+        ):
+            return chunk
+    raise ValueError("Empty response")
+
+
+AsyncCollector = Callable[
+    [ChatCompletionChunk, AsyncIterator[ChatCompletionChunk]],
+    Awaitable[Tuple[Any, CompletionUsage]],
+]
+
+
+async def _astream(
+    messages,
+    model: Optional[str],
+    temperature: Optional[float],
+    tools: List[ChatCompletionToolParam],
+    collect: AsyncCollector,
+) -> Any:
+    messages = _fit_context(messages, model)
+    estimated_tokens = _estimate_tokens(messages)
+    cached_chunks = _cached(messages, model, temperature, tools)
+    from_cache = cached_chunks is not None
+    limit: AsyncContextManager[None] = (
+        nullcontext() if from_cache else limiter.acquire(estimated_tokens)
+    )
+    async with limit:
+        if cached_chunks is not None:
+            response: AsyncIterator[ChatCompletionChunk] = areplay(cached_chunks)
+        else:
+            response = await _agenerate(messages, model, temperature, tools)
+        try:
+            output, usage = await collect(await _afirst_chunk(response), response)
+        except StreamAborted as e:
+            usage = _partial_usage(messages, e.text)
+            _record(model, messages, estimated_tokens, usage, from_cache=from_cache)
+            raise
+    _record(model, messages, estimated_tokens, usage, from_cache=from_cache)
+    return output
+
+
+async def astream_next(
+    messages,
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    tools: List[ChatCompletionToolParam] = [],
+    on_arguments: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Union[str, RawFunctionParams]:
+    async def collect(first_chunk, chunks):
+        if first_chunk.choices[0].delta.content is not None:
+            return await _acollect_text(first_chunk, chunks)
+        return await _acollect_tool(first_chunk, chunks, on_arguments)
+
+    return await _astream(messages, model, temperature, tools, collect)
+
+
+async def astream_text(
+    messages,
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    validators: Sequence[StreamValidator] = (),
+) -> str:
+    return await _astream(
+        messages,
+        model,
+        temperature,
+        [],
+        lambda first_chunk, chunks: _acollect_text(first_chunk, chunks, validators),
+    )
+
+
+async def astream_function(
+    messages,
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    tools: List[ChatCompletionToolParam] = [],
+    on_arguments: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> RawFunctionParams:
+    assert len(tools) > 0
+    return await _astream(
+        messages,
+        model,
+        temperature,
+        tools,
+        lambda first_chunk, chunks: _acollect_tool(first_chunk, chunks, on_arguments),
+    )
+
+
+async def astream(
+    message: str, model: Optional[str] = None, temperature: Optional[float] = None
+) -> str:
+    messages = [{"role": "user", "content": message}]
+    return await astream_text(messages, model, temperature)
+
+
+async def _acollect_text(
+    first_chunk: ChatCompletionChunk,
+    chunks: AsyncIterator[ChatCompletionChunk],
+    validators: Sequence[StreamValidator] = (),
+) -> Tuple[str, CompletionUsage]:
+    assert first_chunk.choices[0].delta.content is not None
+    message = first_chunk.choices[0].delta.content
+    usage = None
+    print_assistant(message, end="", flush=True)
     try:
-        escaped_args = json.loads(escaped_args)
-    except json.JSONDecodeError as e:
-        print_system(args)
-        breakpoint()
-        raise e
-    return _unesacape_quotes(escaped_args)
-
-
-def _escape_quotes(val: str) -> str:
-    return val.replace(r"\\'", "<ESCAPED_QUOTE>").replace(r"\'", "<ESCAPED_QUOTE>")
-
-
-def _unesacape_quotes(val: Any) -> Any:
-    if isinstance(val, str):
-        return val.replace("<ESCAPED_QUOTE>", "\\'")
-    if isinstance(val, List):
-        return [_unesacape_quotes(v) for v in val]
-    if isinstance(val, Dict):
-        return {k: _unesacape_quotes(v) for k, v in val.items()}
-    return val
+        check_delta(validators, message, message)
+        async for chunk in chunks:
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                message += chunk.choices[0].delta.content
+                print_assistant(chunk.choices[0].delta.content, end="", flush=True)
+                check_delta(validators, chunk.choices[0].delta.content, message)
+    except StreamAborted as e:
+        print_assistant()
+        print_system(f"Aborted stream :: {e.reason}")
+        # An async generator, ie, from the cache, or an AsyncStream
+        close = getattr(chunks, "aclose", None) or getattr(chunks, "close", None)
+        if close is not None:
+            await close()
+        raise
+    print_assistant()
+    assert usage
+    return message, usage
+
+
+async def _acollect_tool(
+    first_chunk: ChatCompletionChunk,
+    chunks: AsyncIterator[ChatCompletionChunk],
+    on_arguments: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Tuple[RawFunctionParams, CompletionUsage]:
+    assert first_chunk.choices[0].delta.tool_calls
+    assert first_chunk.choices[0].delta.tool_calls[0].id
+    assert first_chunk.choices[0].delta.tool_calls[0].function
+    assert first_chunk.choices[0].delta.tool_calls[0].function.name
+    tool_id = first_chunk.choices[0].delta.tool_calls[0].id
+    tool_name = first_chunk.choices[0].delta.tool_calls[0].function.name
+    usage = None
+
+    arguments = _ToolArguments(on_arguments)
+    try:
+        arguments.feed(first_chunk)
+        print_assistant(".", end="", flush=True)
+        async for chunk in chunks:
+            if chunk.usage:
+                usage = chunk.usage
+            arguments.feed(chunk)
+            print_assistant(".", end="", flush=True)
+        arguments_list = arguments.close()
+    except MalformedJSONError as e:
+        print_assistant()
+        print_system(f"Malformed arguments :: {e}")
+        close = getattr(chunks, "aclose", None) or getattr(chunks, "close", None)
+        if close is not None:
+            await close()
+        raise StreamAborted(type(e).__name__, str(e), "".join(arguments.raw))
+    print_assistant()
+
+    assert usage
+    return (
+        RawFunctionParams(id=tool_id, name=tool_name, arguments=arguments_list),
+        usage,
+    )
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator
+
+
+class TokenBucket:
+    """Refills `per_minute` units every minute, continuously.
+
+    Shared across threads and event loops. Only the accounting is locked,
+    waiting happens with `time.sleep` or `asyncio.sleep`.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self._rate = per_minute / 60
+        self._available = float(per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._available = min(
+            self.capacity, self._available + (now - self._updated) * self._rate
+        )
+        self._updated = now
+
+    def _try_take(self, amount: int) -> float:
+        """Takes `amount` and returns 0, or else the seconds to wait for it."""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self._available >= amount:
+                self._available -= amount
+                return 0.0
+            return (amount - self._available) / self._rate
+
+    def take_blocking(self, amount: int) -> None:
+        while delay := self._try_take(amount):
+            time.sleep(delay)
+
+    async def take(self, amount: int) -> None:
+        while delay := self._try_take(amount):
+            await asyncio.sleep(delay)
+
+    def adjust(self, amount: int) -> None:
+        """Corrects an estimate once the real amount is known. Can go negative."""
+        with self._lock:
+            self._refill()
+            self._available = min(self.capacity, self._available - amount)
+
+
+class RateLimiter:
+    """The per-minute budgets are shared by the threads and the event loops.
+    The concurrency slots are per event loop, and one more pool for the
+    threads."""
+
+    def __init__(
+        self,
+        *,
+        max_concurrency: int,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+    ):
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._thread_semaphore = threading.BoundedSemaphore(max_concurrency)
+        # asyncio primitives are bound to one event loop
+        self._semaphores: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    @asynccontextmanager
+    async def acquire(self, estimated_tokens: int) -> AsyncIterator[None]:
+        """Holds one concurrency slot while the request (and its stream) runs."""
+        async with self._semaphore():
+            await self.requests.take(1)
+            await self.tokens.take(estimated_tokens)
+            yield
+
+    @contextmanager
+    def hold(self, estimated_tokens: int) -> Iterator[None]:
+        """`acquire`, for the threads."""
+        with self._thread_semaphore:
+            self.requests.take_blocking(1)
+            self.tokens.take_blocking(estimated_tokens)
+            yield
+
+    def record(self, estimated_tokens: int, actual_tokens: int) -> None:
+        self.tokens.adjust(actual_tokens - estimated_tokens)
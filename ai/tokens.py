@@ -1,14 +1,30 @@
 from functools import lru_cache
+from typing import List
 
 import tiktoken
 
 encoding = None
 
 
-@lru_cache(maxsize=1000)
-def count_tokens(content: str, model: str = "gpt-4o") -> int:
+def _get_encoding(model: str) -> tiktoken.Encoding:
     global encoding
     if encoding is None:
         encoding = tiktoken.encoding_for_model(model)
-    count = len(encoding.encode(str(content)))
-    return count
\ No newline at end of file
+    return encoding
+
+
+@lru_cache(maxsize=1000)
+def count_tokens(content: str, model: str = "gpt-4o") -> int:
+    count = len(_get_encoding(model).encode(str(content), disallowed_special=()))
+    return count
+
+
+def count_tokens_batch(contents: List[str], model: str = "gpt-4o") -> List[int]:
+    """Not cached, for large contents that are counted only once."""
+    if not contents:
+        return []
+    encoding = _get_encoding(model)
+    if len(contents) == 1:
+        # encode_batch starts a thread pool on every call
+        return [len(encoding.encode(contents[0], disallowed_special=()))]
+    return [len(t) for t in encoding.encode_batch(contents, disallowed_special=())]
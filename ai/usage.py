@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from openai.types.completion_usage import CompletionUsage
+from pydantic import BaseModel
+
+from utils.files import REPOS
+from utils.state import Conversation
+
+
+REPORTS = f"{REPOS}/.usage"
+# Older records are added up into totals, so that a server doesn't keep them all
+MAX_RECORDS = 10_000
+
+# (input, cached input, output) per 1K tokens
+PRICES_PER_1K: Dict[str, Tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.00015, 0.000075, 0.0006),
+    "gpt-4o": (0.0025, 0.00125, 0.01),
+    "o1-mini": (0.003, 0.0015, 0.012),
+    "o1": (0.015, 0.0075, 0.06),
+}
+
+
+class OCost(BaseModel):
+    PRICE_PER_1K_INPUT: float = 0.0025
+    PRICE_PER_1K_CACHED_INPUT: float = 0.00125
+    PRICE_PER_1K_OUTPUT: float = 0.01
+
+    input: int = 0  # Includes the cached input
+    cached_input: int = 0
+    output: int = 0
+
+    @classmethod
+    def for_model(cls, model: str) -> "OCost":
+        # Longest prefix first, so that dated snapshots get their model's prices
+        for name in sorted(PRICES_PER_1K, key=len, reverse=True):
+            if model.startswith(name):
+                input_price, cached_input_price, output_price = PRICES_PER_1K[name]
+                return cls(
+                    PRICE_PER_1K_INPUT=input_price,
+                    PRICE_PER_1K_CACHED_INPUT=cached_input_price,
+                    PRICE_PER_1K_OUTPUT=output_price,
+                )
+        return cls()
+
+    def add(self, usage: CompletionUsage) -> None:
+        self.input += usage.prompt_tokens
+        self.output += usage.completion_tokens
+        if usage.prompt_tokens_details and usage.prompt_tokens_details.cached_tokens:
+            self.cached_input += usage.prompt_tokens_details.cached_tokens
+
+    def get(self) -> float:
+        return (
+            self.PRICE_PER_1K_INPUT * (self.input - self.cached_input) / 1_000
+            + self.PRICE_PER_1K_CACHED_INPUT * self.cached_input / 1_000
+            + self.PRICE_PER_1K_OUTPUT * self.output / 1_000
+        )
+
+
+class UsageRecord(BaseModel):
+    model: str
+    labels: Dict[str, str]
+    cost: OCost
+    # Input tokens in a prefix that an earlier prompt already sent
+    cache_eligible_input: int = 0
+    # Replayed from the response cache, so nothing was paid
+    from_cache: bool = False
+    # The calls that it adds up, once rolled up
+    calls: int = 1
+
+    def add(self, other: "UsageRecord") -> None:
+        self.cost.input += other.cost.input
+        self.cost.cached_input += other.cost.cached_input
+        self.cost.output += other.cost.output
+        self.cache_eligible_input += other.cache_eligible_input
+        self.calls += other.calls
+
+
+_labels: ContextVar[Dict[str, str]] = ContextVar("usage_labels", default={})
+
+
+@contextmanager
+def usage_scope(**labels: str) -> Iterator[None]:
+    """Labels the usage of every call made in this context, ie, app="todo"."""
+    token = _labels.set({**_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def _summarize(records: List[UsageRecord]) -> Dict[str, Any]:
+    paid = [r for r in records if not r.from_cache]
+    calls = sum(r.calls for r in records)
+    input_tokens = sum(r.cost.input for r in paid)
+    cached_input_tokens = sum(r.cost.cached_input for r in paid)
+    cache_eligible_input_tokens = sum(r.cache_eligible_input for r in paid)
+    return {
+        "calls": calls,
+        "response_cache_hits": calls - sum(r.calls for r in paid),
+        "input_tokens": input_tokens,
+        "cached_input_tokens": cached_input_tokens,
+        "cache_eligible_input_tokens": cache_eligible_input_tokens,
+        "cached_input_fraction": round(cached_input_tokens / max(input_tokens, 1), 4),
+        "cache_eligible_input_fraction": round(
+            cache_eligible_input_tokens / max(input_tokens, 1), 4
+        ),
+        "output_tokens": sum(r.cost.output for r in paid),
+        "cost": round(sum(r.cost.get() for r in paid), 6),
+    }
+
+
+class PrefixTracker:
+    """Measures how much of each prompt repeats the start of an earlier one,
+    ie, could be served from the provider's prompt cache."""
+
+    # OpenAI only caches prompts from this length on
+    MIN_PREFIX_TOKENS = 1024
+
+    def __init__(self, max_prefixes: int = 100_000):
+        self.max_prefixes = max_prefixes
+        self._prefixes: OrderedDict[str, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, messages) -> int:
+        """Returns the tokens of the longest prefix that was already seen."""
+        if not isinstance(messages, Conversation):
+            messages = Conversation(messages)
+        message_tokens = messages.message_tokens()
+
+        chain = []
+        digest = ""
+        for message in messages:
+            digest = hashlib.sha256((digest + message.digest()).encode()).hexdigest()
+            chain.append(digest)
+
+        with self._lock:
+            seen = 0
+            for i, digest in enumerate(chain):
+                if digest not in self._prefixes:
+                    break
+                seen = i + 1
+            for digest in chain:
+                self._prefixes[digest] = None
+                self._prefixes.move_to_end(digest)
+            while len(self._prefixes) > self.max_prefixes:
+                self._prefixes.popitem(last=False)
+
+        tokens = sum(message_tokens[:seen])
+        return tokens if tokens >= self.MIN_PREFIX_TOKENS else 0
+
+
+class UsageLedger:
+    """The usage of each call, until its run's report is saved, or until
+    there are more than `max_records`. Then it's added up into totals by
+    model, labels but the run, and cache, which the reports still count."""
+
+    def __init__(self, max_records: int = MAX_RECORDS) -> None:
+        self.max_records = max_records
+        self._records: List[UsageRecord] = []
+        self._totals: Dict[Tuple[Any, ...], UsageRecord] = {}
+        self._lock = threading.Lock()
+
+    def _roll_up(self, records: List[UsageRecord]) -> None:
+        for record in records:
+            labels = {k: v for k, v in record.labels.items() if k != "run"}
+            key = (record.model, tuple(sorted(labels.items())), record.from_cache)
+            if key in self._totals:
+                self._totals[key].add(record)
+            else:
+                self._totals[key] = record.model_copy(
+                    update={"labels": labels}, deep=True
+                )
+
+    def record(
+        self,
+        model: str,
+        usage: CompletionUsage,
+        *,
+        from_cache: bool = False,
+        cache_eligible_input: int = 0,
+    ) -> UsageRecord:
+        cost = OCost.for_model(model)
+        cost.add(usage)
+        record = UsageRecord(
+            model=model,
+            labels=_labels.get(),
+            cost=cost,
+            cache_eligible_input=min(cache_eligible_input, usage.prompt_tokens),
+            from_cache=from_cache,
+        )
+        with self._lock:
+            self._records.append(record)
+            if len(self._records) > self.max_records:
+                half = len(self._records) // 2
+                self._roll_up(self._records[:half])
+                del self._records[:half]
+        return record
+
+    def records(self, **labels: str) -> List[UsageRecord]:
+        with self._lock:
+            records = list(self._totals.values()) + self._records
+        return [
+            r for r in records if all(r.labels.get(k) == v for k, v in labels.items())
+        ]
+
+    def report(self, **labels: str) -> Dict[str, Any]:
+        """Totals of the calls with `labels`, also broken down by model, app and
+        component."""
+        records = self.records(**labels)
+        report: Dict[str, Any] = {"labels": labels, **_summarize(records)}
+        for group, label in [
+            ("by_model", None),
+            ("by_app", "app"),
+            ("by_component", "component"),
+        ]:
+            grouped: Dict[str, List[UsageRecord]] = {}
+            for r in records:
+                key = r.model if label is None else r.labels.get(label)
+                if key is not None:
+                    grouped.setdefault(key, []).append(r)
+            report[group] = {k: _summarize(v) for k, v in grouped.items()}
+        return report
+
+    def save_report(self, app_name: str, run: str) -> str:
+        os.makedirs(f"{REPORTS}/{app_name}", exist_ok=True)
+        path = f"{REPORTS}/{app_name}/{run}.json"
+        with open(path, "w") as f:
+            json.dump(self.report(app=app_name, run=run), f, indent=2)
+        # The run is over, and its calls are in the report
+        with self._lock:
+            finished: List[UsageRecord] = []
+            remaining: List[UsageRecord] = []
+            for r in self._records:
+                if r.labels.get("app") == app_name and r.labels.get("run") == run:
+                    finished.append(r)
+                else:
+                    remaining.append(r)
+            self._roll_up(finished)
+            self._records = remaining
+        return path
+
+
+ledger = UsageLedger()
+prefixes = PrefixTracker()
+
+
+def load_reports(app_name: str) -> List[Dict[str, Any]]:
+    reports_dir = f"{REPORTS}/{app_name}"
+    if not os.path.exists(reports_dir):
+        return []
+    reports = []
+    for name in sorted(os.listdir(reports_dir)):
+        with open(f"{reports_dir}/{name}", "r") as f:
+            reports.append(json.load(f))
+    return reports
@@ -0,0 +1,74 @@
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional, Sequence
+
+
+class StreamAborted(Exception):
+    """A validator closed the stream before its end. `text` is what was
+    streamed until then."""
+
+    def __init__(self, validator: str, reason: str, text: str):
+        self.validator = validator
+        self.reason = reason
+        self.text = text
+        super().__init__(reason)
+
+
+class StreamValidator(ABC):
+    """Looks at a stream as it arrives. Keeps state, so use a new one for
+    each stream."""
+
+    @abstractmethod
+    def feed(self, delta: str) -> Optional[str]:
+        """The reason to abort the stream after `delta`, if any."""
+
+
+class MaxCodeBlocks(StreamValidator):
+    def __init__(self, max_blocks: int = 1, marker: str = "```python"):
+        self.max_blocks = max_blocks
+        self.marker = marker
+        self.blocks = 0
+        # The end of the text so far, in case a marker is split across deltas
+        self._tail = ""
+
+    def feed(self, delta: str) -> Optional[str]:
+        text = self._tail + delta
+        self.blocks += text.count(self.marker)
+        # Without a whole marker, so that it's not counted twice
+        self._tail = text[-(len(self.marker) - 1) :]
+        if self.blocks > self.max_blocks:
+            return f"Found more than {self.max_blocks} code blocks."
+        return None
+
+
+class MaxLength(StreamValidator):
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+        self.length = 0
+
+    def feed(self, delta: str) -> Optional[str]:
+        self.length += len(delta)
+        if self.length > self.max_chars:
+            return f"The response is longer than {self.max_chars} characters."
+        return None
+
+
+class Cancelled(StreamValidator):
+    """Aborts the stream once `event` is set, ie, when it's no longer needed."""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def feed(self, delta: str) -> Optional[str]:
+        if self.event.is_set():
+            return "The response is no longer needed."
+        return None
+
+
+def check_delta(validators: Sequence[StreamValidator], delta: str, text: str) -> None:
+    """Raises StreamAborted if any of `validators` rejects `delta`, the end of
+    `text`."""
+    for validator in validators:
+        reason = validator.feed(delta)
+        if reason is not None:
+            raise StreamAborted(type(validator).__name__, reason, text)
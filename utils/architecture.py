@@ -1,8 +1,22 @@
+import hashlib
 import json
-from typing import Any, Dict, List, Optional, Union, Annotated, Literal
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    Annotated,
+    Literal,
+)
 
 from pydantic import BaseModel, Field, RootModel
 
+from utils.dependency_graph import DependencyGraph
 from utils.files import File, REPOS
 from utils.io import print_system
 
@@ -32,6 +46,10 @@ class SQLAlchemyModel(BaseComponent):
         description="The other sqlalchemymodels that this model is associated with"
     )
 
+    @property
+    def dependencies(self) -> List[str]:
+        return self.associations
+
 
 class Function(BaseComponent):
     type: Literal["function"] = "function"
@@ -41,6 +59,10 @@ class Function(BaseComponent):
     )
     is_endpoint: bool = Field(description="Whether this is a FastAPI endpoint")
 
+    @property
+    def dependencies(self) -> List[str]:
+        return self.uses
+
 
 class Component(RootModel):
     root: Annotated[Union[SQLAlchemyModel, Function], Field(discriminator="type")]
@@ -49,6 +71,10 @@ class Component(RootModel):
     def key(self) -> str:
         return self.root.key
 
+    @property
+    def dependencies(self) -> List[str]:
+        return self.root.dependencies
+
     @classmethod
     def model_json_schema(cls) -> Dict[str, Any]:
         """Returns a simplified schema suitable for OpenAI function calls"""
@@ -77,20 +103,146 @@ class Component(RootModel):
         return base_schema
 
 
+def _hash(payload: Any) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+# Bookkeeping of the implementation, that the prompts don't need
+HASH_FIELDS = {"spec_hash", "dependency_hashes", "file_hash"}
+
+
 class ImplementedComponent(BaseModel):
     base: Component
     file: Optional[File] = None
+    # What the file was generated from, to tell when it's outdated
+    spec_hash: Optional[str] = None
+    dependency_hashes: Dict[str, str] = {}
+    file_hash: Optional[str] = None
+
+    def current_spec_hash(self) -> str:
+        return _hash(self.base.model_dump())
+
+    def _dependency_hashes(self, spec_hashes: Dict[str, str]) -> Dict[str, str]:
+        # Dependencies outside of the architecture are already implemented
+        return {d: spec_hashes[d] for d in self.base.dependencies if d in spec_hashes}
+
+    def closure_hash(self, spec_hashes: Optional[Dict[str, str]] = None) -> str:
+        """The hash of the specs of the component and of its dependencies:
+        the current ones, in `spec_hashes`, or else the ones that its file was
+        generated from."""
+        if spec_hashes is None:
+            return _hash([self.spec_hash, self.dependency_hashes])
+        return _hash([spec_hashes[self.base.key], self._dependency_hashes(spec_hashes)])
+
+    def record_hashes(self, spec_hashes: Dict[str, str]) -> None:
+        """Records that the file was generated from the current specs."""
+        self.spec_hash = spec_hashes[self.base.key]
+        self.dependency_hashes = self._dependency_hashes(spec_hashes)
+        self.file_hash = _hash(self.file.content) if self.file else None
+
+    def file_changed(self, content: str) -> bool:
+        """Whether `content` isn't the file that was generated, ie, it was
+        edited by hand."""
+        return self.file_hash is not None and _hash(content) != self.file_hash
+
+    def dump_for_prompt(self) -> Dict[str, Any]:
+        return self.model_dump(exclude=HASH_FIELDS)
+
+
+def _key_and_dependencies(
+    component: Union[ImplementedComponent, Dict[str, Any]],
+) -> Tuple[str, List[str]]:
+    if isinstance(component, ImplementedComponent):
+        return component.base.key, component.base.dependencies
+    # Read from the raw component, so that it doesn't need to be validated
+    base = component["base"]
+    key = f"{base['namespace']}.{base['name']}" if base["namespace"] else base["name"]
+    if base["type"] == "sqlalchemymodel":
+        return key, base["associations"]
+    return key, base["uses"]
+
+
+class Architecture:
+    """The components of an app by key, in the order that they were added.
+
+    Raw components, ie, from a config file, are only validated when they're
+    accessed. `graph` holds the dependencies between them.
+    """
+
+    def __init__(
+        self,
+        components: Iterable[Union[ImplementedComponent, Dict[str, Any]]] = (),
+    ):
+        self._components: Dict[str, Union[ImplementedComponent, Dict[str, Any]]] = {}
+        self.graph = DependencyGraph()
+        for component in components:
+            self.add(component)
+
+    def add(self, component: Union[ImplementedComponent, Dict[str, Any]]) -> None:
+        """Adds the component, or replaces the one with the same key in place."""
+        key, dependencies = _key_and_dependencies(component)
+        self._components[key] = component
+        self.graph.set_dependencies(key, dependencies)
+
+    def remove(self, key: str) -> None:
+        del self._components[key]
+        self.graph.remove_node(key)
+
+    def update(self, components: Iterable[ImplementedComponent]) -> None:
+        for component in components:
+            self.add(component)
+
+    def __setitem__(self, key: str, component: ImplementedComponent) -> None:
+        assert key == component.base.key
+        self.add(component)
+
+    def __getitem__(self, key: str) -> ImplementedComponent:
+        component = self._components[key]
+        if not isinstance(component, ImplementedComponent):
+            component = ImplementedComponent.model_validate(component)
+            self._components[key] = component
+        return component
+
+    def get(self, key: str) -> Optional[ImplementedComponent]:
+        return self[key] if key in self._components else None
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._components
+
+    def __len__(self) -> int:
+        return len(self._components)
+
+    def __iter__(self) -> Iterator[ImplementedComponent]:
+        for key in list(self._components):
+            yield self[key]
+
+    def keys(self) -> List[str]:
+        return list(self._components)
+
+    def values(self) -> List[ImplementedComponent]:
+        return list(self)
+
+    def used_by(self, key: str) -> Set[str]:
+        """The keys of the components that depend on `key`."""
+        return self.graph.dependents(key)
+
+    def copy(self) -> "Architecture":
+        """Shares the components."""
+        return Architecture(self._components.values())
+
+    def dump(self) -> List[Dict[str, Any]]:
+        return [
+            c.model_dump() if isinstance(c, ImplementedComponent) else c
+            for c in self._components.values()
+        ]
 
 
 def load_config(app_name: str) -> Dict[str, Any]:
     with open(f"{REPOS}/{app_name}/config.json", "r") as f:
         config = json.load(f)
-    print_system(json.dumps(config, indent=2))
     return {
         "name": config["name"],
-        "architecture": [
-            ImplementedComponent.model_validate(a) for a in config["architecture"]
-        ],
+        "architecture": Architecture(config["architecture"]),
         "pypi_packages": config["pypi_packages"],
         "external_infrastructure": config["external_infrastructure"],
         "github": config["github"],
@@ -98,17 +250,21 @@ def load_config(app_name: str) -> Dict[str, Any]:
     }
 
 
-def save_config(config: Dict[str, Any]) -> None:
-    assert isinstance(config["architecture"], List)
-    raw_architecture = [c.model_dump() for c in config["architecture"]]
-    raw_config = {
+def dump_config(config: Dict[str, Any]) -> Dict[str, Any]:
+    """As saved in the config file, ie, for a json response."""
+    return {
         "name": config["name"],
-        "architecture": raw_architecture,
+        "architecture": config["architecture"].dump(),
         "pypi_packages": config["pypi_packages"],
         "external_infrastructure": config["external_infrastructure"],
         "github": config["github"],
         "url": config["url"],
     }
+
+
+def save_config(config: Dict[str, Any]) -> None:
+    assert isinstance(config["architecture"], Architecture)
+    raw_config = dump_config(config)
     print_system(json.dumps(raw_config, indent=2))
     with open(f"{REPOS}/{config['name']}/config.json", "w") as f:
         json.dump(
@@ -118,21 +274,6 @@ def save_config(config: Dict[str, Any]) -> None:
         )
 
 
-def update_architecture_diff(
-    architecture: List[ImplementedComponent],
-    architecture_diff: List[ImplementedComponent],
-) -> None:
-    for component in architecture_diff:
-        found = False
-        for i, existing_component in enumerate(architecture):
-            if component.base.key == existing_component.base.key:
-                architecture[i] = component
-                found = True
-                break
-        if not found:
-            architecture.append(component)
-
-
 initial_config = {
     "architecture": [
         ImplementedComponent(
@@ -263,10 +404,12 @@ def create_initial_config(
     config = initial_config.copy()
     config["name"] = app_name
 
+    architecture = Architecture(initial_config["architecture"])
     if "database" in external_infrastructure:
-        config["architecture"].extend(db_components)
+        architecture.update(db_components)
         if "authentication" in external_infrastructure:
-            config["architecture"].extend(auth_components)
+            architecture.update(auth_components)
+    config["architecture"] = architecture
     config["external_infrastructure"] = external_infrastructure
     config["github"] = github_url
     save_config(config)
@@ -0,0 +1,170 @@
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set
+
+import networkx as nx
+
+if TYPE_CHECKING:
+    from utils.architecture import ImplementedComponent
+
+
+class CircularDependencyError(ValueError):
+    def __init__(self, cycle: List[str]):
+        self.cycle = cycle
+        super().__init__(f"Circular dependency detected :: {' -> '.join(cycle)}")
+
+
+class DependencyGraph:
+    """The dependencies between components, by key, updated in place.
+
+    Dependencies on keys that aren't nodes of the graph are kept, ie, for
+    components that aren't part of it yet, but they're ignored by the
+    analyses, as if they were already implemented.
+    """
+
+    def __init__(self) -> None:
+        self._dependencies: Dict[str, Set[str]] = {}
+        self._dependents: Dict[str, Set[str]] = {}
+
+    @classmethod
+    def from_components(
+        cls, components: Iterable["ImplementedComponent"]
+    ) -> "DependencyGraph":
+        graph = cls()
+        for component in components:
+            graph.set_dependencies(component.base.key, component.base.dependencies)
+        return graph
+
+    def set_dependencies(self, key: str, dependencies: Iterable[str]) -> None:
+        """Adds the node, or replaces its dependencies."""
+        for dependency in self._dependencies.get(key, set()):
+            self._dependents[dependency].discard(key)
+        self._dependencies[key] = set()
+        for dependency in dependencies:
+            self.add_edge(key, dependency)
+
+    def remove_node(self, key: str) -> None:
+        for dependency in self._dependencies.pop(key, set()):
+            self._dependents[dependency].discard(key)
+
+    def add_edge(self, key: str, dependency: str) -> None:
+        self._dependencies.setdefault(key, set()).add(dependency)
+        self._dependents.setdefault(dependency, set()).add(key)
+
+    def remove_edge(self, key: str, dependency: str) -> None:
+        self._dependencies.get(key, set()).discard(dependency)
+        self._dependents.get(dependency, set()).discard(key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._dependencies
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._dependencies)
+
+    def __len__(self) -> int:
+        return len(self._dependencies)
+
+    def dependencies(self, key: str) -> Set[str]:
+        """The dependencies of `key` that are nodes of the graph."""
+        return {d for d in self._dependencies.get(key, ()) if d in self._dependencies}
+
+    def dependents(self, key: str) -> Set[str]:
+        """The nodes that depend on `key`, which doesn't need to be a node."""
+        return set(self._dependents.get(key, ()))
+
+    def find_cycle(self, start: Optional[str] = None) -> Optional[List[str]]:
+        """A cycle, ie, ["a", "b", "a"], through `start` if given, or None."""
+        visited: Set[str] = set()
+        for root in [start] if start is not None else list(self._dependencies):
+            if root in visited or root not in self._dependencies:
+                continue
+            # Iterative depth-first search, with the path to the current node
+            path = [root]
+            on_path = {root}
+            stack = [iter(sorted(self.dependencies(root)))]
+            visited.add(root)
+            while stack:
+                dependency = next(stack[-1], None)
+                if dependency is None:
+                    stack.pop()
+                    on_path.discard(path.pop())
+                elif dependency in on_path:
+                    cycle = path[path.index(dependency) :] + [dependency]
+                    if start is None or start in cycle:
+                        return cycle
+                elif dependency not in visited:
+                    visited.add(dependency)
+                    path.append(dependency)
+                    on_path.add(dependency)
+                    stack.append(iter(sorted(self.dependencies(dependency))))
+        return None
+
+    def check_acyclic(self) -> None:
+        cycle = self.find_cycle()
+        if cycle is not None:
+            raise CircularDependencyError(cycle)
+
+    def levels(self) -> List[Set[str]]:
+        """Kahn's algorithm: each level only depends on the previous ones."""
+        remaining = {key: len(self.dependencies(key)) for key in self._dependencies}
+        level = {key for key, count in remaining.items() if count == 0}
+        levels = []
+        while level:
+            levels.append(level)
+            next_level = set()
+            for key in level:
+                del remaining[key]
+                for dependent in self._dependents.get(key, ()):
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        next_level.add(dependent)
+            level = next_level
+        if remaining:
+            cycle = self.find_cycle(next(iter(sorted(remaining))))
+            raise CircularDependencyError(cycle or self.find_cycle() or [])
+        return levels
+
+    def critical_path(self, weights: Optional[Dict[str, float]] = None) -> List[str]:
+        """The chain of dependencies with the largest total weight, from the
+        first dependency to the last dependent. Each node weighs 1 by default."""
+        weights = weights or {}
+        # Heaviest chain that ends at each node, and the node before it
+        totals: Dict[str, float] = {}
+        previous: Dict[str, Optional[str]] = {}
+        for level in self.levels():
+            for key in sorted(level):
+                before = max(
+                    self.dependencies(key), key=lambda d: totals[d], default=None
+                )
+                totals[key] = weights.get(key, 1.0) + (
+                    totals[before] if before is not None else 0.0
+                )
+                previous[key] = before
+        if not totals:
+            return []
+        node: Optional[str] = max(totals, key=lambda k: totals[k])
+        path = []
+        while node is not None:
+            path.append(node)
+            node = previous[node]
+        return path[::-1]
+
+    def downstream_lengths(
+        self, weights: Optional[Dict[str, float]] = None
+    ) -> Dict[str, float]:
+        """The total weight of the heaviest chain of dependents that starts at
+        each node, including the node. Each node weighs 1 by default."""
+        weights = weights or {}
+        lengths: Dict[str, float] = {}
+        for level in reversed(self.levels()):
+            for key in level:
+                lengths[key] = weights.get(key, 1.0) + max(
+                    (lengths[d] for d in self._dependents.get(key, ())), default=0.0
+                )
+        return lengths
+
+    def to_networkx(self) -> nx.DiGraph:
+        G = nx.DiGraph()
+        for key, dependencies in self._dependencies.items():
+            G.add_node(key)
+            for dependency in dependencies:
+                G.add_edge(key, dependency)
+        return G
@@ -1,13 +1,41 @@
-from typing import Any
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator, Tuple
+
+
+# Receives (kind, text) for everything printed, ie, ("assistant", delta)
+Sink = Callable[[str, str], None]
+
+_sinks: ContextVar[Tuple[Sink, ...]] = ContextVar("sinks", default=())
+
+
+@contextmanager
+def add_sink(sink: Sink) -> Iterator[None]:
+    """Also sends the output of the current context to `sink`.
+
+    Threads don't inherit it. Submit work with `contextvars.copy_context().run`.
+    """
+    token = _sinks.set(_sinks.get() + (sink,))
+    try:
+        yield
+    finally:
+        _sinks.reset(token)
+
+
+def _emit(kind: str, text: str) -> None:
+    for sink in _sinks.get():
+        sink(kind, text)
 
 
 def print_system(message: Any = "", end: str = "\n") -> str:
     print(f"\033[0;0m{message}", end=end)
+    _emit("system", f"{message}{end}")
     return message
 
 
 def print_assistant(message="", end: str = "\n", flush: bool = False) -> str:
     print(f"\033[92m{message}", end=end, flush=flush)
+    _emit("assistant", f"{message}{end}")
     return message
 
 
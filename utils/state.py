@@ -1,13 +1,149 @@
 from datetime import datetime
+import hashlib
 import json
-from copy import deepcopy
-from typing import Any, Dict, List, Optional
+import re
+from typing import Any, Dict, Iterable, List, Optional, SupportsIndex, Union
 
-from ai.tokens import count_tokens
+from ai.tokens import count_tokens_batch
 from utils.files import REPOS
+from utils.static_analysis import extract_signatures
+
+
+def _message_text(message: Dict[str, Any]) -> str:
+    """The parts of a message that count as tokens, including tool calls."""
+    parts = []
+    if isinstance(message.get("content"), str):
+        parts.append(message["content"])
+    for tool_call in message.get("tool_calls") or []:
+        parts.append(tool_call["function"]["name"])
+        parts.append(tool_call["function"]["arguments"])
+    return "\n".join(parts)
+
+
+_CODE_BLOCK = re.compile(r"```python\n(.*?)```", re.DOTALL)
+_SAVED_FILE = re.compile(r"^I saved the code in (.+)\.$")
+_ERRORS = "Found the following errors ::"
+
+
+def _signatures_only(content: str) -> str:
+    def _replace(match: re.Match) -> str:
+        try:
+            signatures = extract_signatures(match.group(1))
+        except SyntaxError:
+            return match.group(0)
+        return f"```python\n# Implementation omitted\n{signatures}\n```"
+
+    return _CODE_BLOCK.sub(_replace, content)
+
+
+class Message(Dict[str, Any]):
+    """A message that can't be modified in place, so that it can be shared by
+    every fork of a conversation. Replace it instead."""
+
+    def _read_only(self, *args: Any, **kwargs: Any) -> None:
+        raise TypeError("Messages are read-only, replace the message instead")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only  # type: ignore
+    clear = pop = popitem = setdefault = update = _read_only  # type: ignore
+
+    def digest(self) -> str:
+        if "_digest" not in self.__dict__:
+            payload = json.dumps(self, sort_keys=True, default=str)
+            self._digest = hashlib.sha256(payload.encode()).hexdigest()
+        return self._digest
+
+    def __reduce__(self) -> Any:
+        return Message, (dict(self),)
+
+    def __copy__(self) -> "Message":
+        return self
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> "Message":
+        return self
+
+
+def _freeze(message: Dict[str, Any]) -> Message:
+    return message if isinstance(message, Message) else Message(message)
+
+
+def _count_message_tokens(messages: Iterable[Dict[str, Any]]) -> List[int]:
+    return count_tokens_batch([_message_text(m) for m in messages])
 
 
 class Conversation(List[Dict[str, Any]]):
+    """A list of messages that keeps count of its tokens as it changes."""
+
+    def __init__(self, messages: Iterable[Dict[str, Any]] = ()):
+        super().__init__(_freeze(m) for m in messages)
+        self._message_tokens = _count_message_tokens(self)
+        self._tokens = sum(self._message_tokens)
+
+    def append(self, message: Dict[str, Any]) -> None:
+        super().append(_freeze(message))
+        self._message_tokens.extend(_count_message_tokens([message]))
+        self._tokens += self._message_tokens[-1]
+
+    def extend(self, messages: Iterable[Dict[str, Any]]) -> None:
+        messages = [_freeze(m) for m in messages]
+        super().extend(messages)
+        tokens = _count_message_tokens(messages)
+        self._message_tokens.extend(tokens)
+        self._tokens += sum(tokens)
+
+    def __iadd__(  # type: ignore[override, misc]
+        self, messages: Iterable[Dict[str, Any]]
+    ) -> "Conversation":
+        self.extend(messages)
+        return self
+
+    def insert(self, index: SupportsIndex, message: Dict[str, Any]) -> None:
+        super().insert(index, _freeze(message))
+        tokens = _count_message_tokens([message])[0]
+        self._message_tokens.insert(index, tokens)
+        self._tokens += tokens
+
+    def pop(self, index: SupportsIndex = -1) -> Dict[str, Any]:
+        message = super().pop(index)
+        self._tokens -= self._message_tokens.pop(index)
+        return message
+
+    def remove(self, message: Dict[str, Any]) -> None:
+        del self[self.index(message)]
+
+    def clear(self) -> None:
+        super().clear()
+        self._message_tokens = []
+        self._tokens = 0
+
+    def __delitem__(self, index: Union[SupportsIndex, slice]) -> None:
+        super().__delitem__(index)
+        removed = self._message_tokens[index]
+        self._tokens -= sum(removed) if isinstance(removed, list) else removed
+        del self._message_tokens[index]
+
+    def __setitem__(self, index, value) -> None:
+        if isinstance(index, slice):
+            value = [_freeze(m) for m in value]
+        else:
+            value = _freeze(value)
+        super().__setitem__(index, value)
+        if isinstance(index, slice):
+            slice_tokens = _count_message_tokens(value)
+            self._tokens += sum(slice_tokens) - sum(self._message_tokens[index])
+            self._message_tokens[index] = slice_tokens
+        else:
+            item_tokens = _count_message_tokens([value])[0]
+            self._tokens += item_tokens - self._message_tokens[index]
+            self._message_tokens[index] = item_tokens
+
+    def sort(self, *args, **kwargs) -> None:
+        super().sort(*args, **kwargs)
+        self._message_tokens = _count_message_tokens(self)
+
+    def reverse(self) -> None:
+        super().reverse()
+        self._message_tokens.reverse()
+
     def add_assistant(self, message: str, *, type_: Optional[str] = None) -> None:
         if type_ is not None:
             self.append({"role": "assistant", "content": message, "type": type_})
@@ -75,7 +211,66 @@ class Conversation(List[Dict[str, Any]]):
                 break
 
     def copy(self) -> "Conversation":
-        return deepcopy(self)
+        """Forks the conversation. Messages are read-only, so the fork shares
+        them with the original instead of copying them."""
+        copied = Conversation.__new__(Conversation)
+        list.extend(copied, self)
+        copied._message_tokens = list(self._message_tokens)
+        copied._tokens = self._tokens
+        return copied
+
+    def __reduce__(self) -> Any:
+        return Conversation, (list(self),)
+
+    def __copy__(self) -> "Conversation":
+        return self.copy()
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> "Conversation":
+        return self.copy()
+
+    def compact(self, max_tokens: int, *, keep_last: int = 2) -> "Conversation":
+        """Returns a copy that fits in `max_tokens`, if it can, by compacting
+        the oldest code first. The last `keep_last` messages are left as they
+        are.
+
+        1. Drops the code of files that were saved again later, and of failed
+           attempts that were retried again later.
+        2. Replaces the rest of the code with its signatures, oldest first.
+        """
+        compacted = self.copy()
+        if compacted.count_tokens() <= max_tokens:
+            return compacted
+        end = len(compacted) - keep_last
+
+        superseded = []
+        last_saves: Dict[str, int] = {}
+        last_failure = None
+        for i, message in enumerate(compacted):
+            saved_file = _SAVED_FILE.match(str(message.get("content")))
+            if saved_file and i > 0:
+                if saved_file.group(1) in last_saves:
+                    superseded.append(last_saves[saved_file.group(1)])
+                last_saves[saved_file.group(1)] = i - 1
+            elif str(message.get("content")).startswith(_ERRORS) and i > 0:
+                if last_failure is not None:
+                    superseded.append(last_failure)
+                last_failure = i - 1
+        for i in sorted(i for i in superseded if i < end):
+            compacted[i] = {
+                **compacted[i],
+                "content": _CODE_BLOCK.sub(
+                    "(Code omitted, superseded by a later version.)",
+                    compacted[i]["content"],
+                ),
+            }
+
+        for i in range(end):
+            if compacted.count_tokens() <= max_tokens:
+                break
+            content = compacted[i].get("content")
+            if isinstance(content, str) and "```python" in content:
+                compacted[i] = {**compacted[i], "content": _signatures_only(content)}
+        return compacted
 
     def empty(self) -> bool:
         return len(self) == 0
@@ -85,7 +280,10 @@ class Conversation(List[Dict[str, Any]]):
             json.dump(self, file, indent=4)
 
     def count_tokens(self) -> int:
-        return sum(count_tokens(m["content"]) for m in self)
+        return self._tokens
+
+    def message_tokens(self) -> List[int]:
+        return list(self._message_tokens)
 
     @staticmethod
     def load(app_name: str) -> "Conversation":
@@ -1,27 +1,161 @@
 import ast
-import importlib
-import importlib.util
+import copy
+import glob
+import os
 import sys
-from typing import List
+import threading
+from functools import cached_property, lru_cache
+from typing import Dict, List, Set
+
+from utils.files import REPOS
+
+
+class CodeSummary:
+    """Everything that the workflows look up in a file, from a single parse.
+
+    Shared by every caller with the same code, so don't modify it.
+    """
+
+    def __init__(self, code: str):
+        self.tree = ast.parse(code)
+        routers: List[str] = []
+        models: List[str] = []
+        imports: List[str] = []
+        for node in ast.walk(self.tree):
+            if isinstance(node, ast.Assign):
+                if (
+                    len(node.targets) == 1
+                    and isinstance(node.targets[0], ast.Name)
+                    and isinstance(node.value, ast.Call)
+                    and isinstance(node.value.func, ast.Name)
+                    and node.value.func.id == "APIRouter"
+                ):
+                    routers.append(node.targets[0].id)
+            elif isinstance(node, ast.ClassDef):
+                if any(
+                    isinstance(base, ast.Name) and base.id == "Base"
+                    for base in node.bases
+                ):
+                    models.append(node.name)
+            elif isinstance(node, ast.Import):
+                imports.extend(name.name for name in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                # Relative imports are within the app
+                if node.module and node.level == 0:
+                    imports.append(node.module)
+        self.routers = tuple(routers)
+        self.models = tuple(models)
+        self.imports = tuple(imports)
+        self.symbols = tuple(_top_level_symbols(self.tree))
+
+    @cached_property
+    def signatures(self) -> str:
+        """The code without function bodies: imports, classes, decorators,
+        typed signatures and docstrings."""
+        tree = copy.deepcopy(self.tree)
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                body: List[ast.stmt] = []
+                docstring = ast.get_docstring(node, clean=False)
+                if docstring is not None:
+                    body.append(ast.Expr(ast.Constant(docstring)))
+                body.append(ast.Expr(ast.Constant(...)))
+                node.body = body
+        return ast.unparse(tree)
+
+
+def _top_level_symbols(tree: ast.Module) -> List[str]:
+    symbols = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            symbols.append(node.name)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    symbols.append(target.id)
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            symbols.append(node.target.id)
+    return symbols
+
+
+@lru_cache(maxsize=256)
+def analyze(code: str) -> CodeSummary:
+    """Raises SyntaxError if the code doesn't parse."""
+    return CodeSummary(code)
+
+
+class ModuleIndex:
+    """The top-level modules that a venv can import: the standard library and
+    everything in its site-packages."""
+
+    def __init__(self, venv_path: str):
+        self.site_packages = sorted(glob.glob(f"{venv_path}/lib/python*/site-packages"))
+        self.version = self._version()
+        self.modules: Set[str] = set(sys.stdlib_module_names)
+        self.modules.update(sys.builtin_module_names)
+        for site_packages in self.site_packages:
+            self._index(site_packages)
+
+    def _version(self) -> List[int]:
+        return [os.stat(path).st_mtime_ns for path in self.site_packages]
+
+    def outdated(self) -> bool:
+        """Installing or removing a package changes its site-packages."""
+        return self._version() != self.version
+
+    def _index(self, site_packages: str) -> None:
+        for entry in os.scandir(site_packages):
+            if entry.name.endswith(".dist-info"):
+                top_level = os.path.join(entry.path, "top_level.txt")
+                if os.path.exists(top_level):
+                    with open(top_level, "r") as f:
+                        self.modules.update(line.strip() for line in f if line.strip())
+            elif entry.is_dir():
+                if entry.name.isidentifier():
+                    self.modules.add(entry.name)
+            elif entry.name.endswith((".py", ".so", ".pyd")):
+                # ie, six.py or _cffi_backend.cpython-311-x86_64-linux-gnu.so
+                self.modules.add(entry.name.split(".")[0])
+
+    def __contains__(self, module: str) -> bool:
+        return module.split(".")[0] in self.modules
+
+
+_module_indexes: Dict[str, ModuleIndex] = {}
+_module_indexes_lock = threading.Lock()
+
+
+def get_module_index(venv_path: str) -> ModuleIndex:
+    """Built once per venv, and again when its requirements change."""
+    with _module_indexes_lock:
+        index = _module_indexes.get(venv_path)
+        if index is None or index.outdated():
+            index = _module_indexes[venv_path] = ModuleIndex(venv_path)
+        return index
+
+
+class MissingImportError(Exception):
+    pass
+
+
+def _app_module_exists(app_dir: str, module: str) -> bool:
+    path = os.path.join(app_dir, *module.split("."))
+    return os.path.exists(f"{path}.py") or os.path.isdir(path)
 
 
 def check_imports(code: str, app_name: str) -> None:
-    site_packages = f"db/repos/{app_name}/venv/lib/python3.13/site-packages"
-    sys.path.append(site_packages)
-    site_packages = f"db/repos/{app_name}/venv/lib/python3.11/site-packages"
-    sys.path.append(site_packages)
-
-    tree = ast.parse(code)
-    for node in ast.walk(tree):
-        if isinstance(node, ast.Import):
-            for name in node.names:
-                if importlib.util.find_spec(name.name) is None:
-                    raise ImportError(f"Module {name.name} not found")
-        elif isinstance(node, ast.ImportFrom):
-            if node.module:
-                if importlib.util.find_spec(node.module) is None:
-                    raise ImportError(f"Module {node.module} not found")
-                # Note: We can't easily verify submodule imports without loading the module
+    """The modules of the app are looked up in its tree, which changes as its
+    components are written, everything else in the index of its venv."""
+    app_dir = f"{REPOS}/{app_name}"
+    index = get_module_index(f"{app_dir}/venv")
+
+    for module in analyze(code).imports:
+        if module == "app" or module.startswith("app."):
+            found = _app_module_exists(app_dir, module)
+        else:
+            found = module in index
+        if not found:
+            raise MissingImportError(f"Module {module} not found")
 
 
 class RouterNotFoundError(Exception):
@@ -29,24 +163,15 @@ class RouterNotFoundError(Exception):
 
 
 def extract_router_name(code: str) -> str:
-    tree = ast.parse(code)
-    for node in ast.walk(tree):
-        if isinstance(node, ast.Assign):
-            if len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
-                if isinstance(node.value, ast.Call):
-                    if isinstance(node.value.func, ast.Name):
-                        if node.value.func.id == "APIRouter":
-                            return node.targets[0].id
-    raise RouterNotFoundError("No APIRouter found")
+    routers = analyze(code).routers
+    if not routers:
+        raise RouterNotFoundError("No APIRouter found")
+    return routers[0]
 
 
 def extract_sqlalchemy_models(code: str) -> List[str]:
-    models = []
-    tree = ast.parse(code)
-    for node in ast.walk(tree):
-        if isinstance(node, ast.ClassDef):
-            for base in node.bases:
-                if isinstance(base, ast.Name) and base.id == "Base":
-                    models.append(node.name)
-                    break
-    return models
+    return list(analyze(code).models)
+
+
+def extract_signatures(code: str) -> str:
+    return analyze(code).signatures
@@ -3,6 +3,8 @@ from typing import Any, Dict, List
 from fastapi import APIRouter
 from pydantic import BaseModel
 
+from utils.architecture import dump_config
+from web.jobs import Job, queue
 from workflows.helpers import create_app
 
 router = APIRouter()
@@ -13,6 +15,16 @@ class Request(BaseModel):
     external_infrastructure: List[str] = ["http", "database"]
 
 
-@router.post("", response_model=Dict[str, Any])
-async def create(request: Request) -> Dict[str, Any]:
-    return create_app(request.app_name, request.external_infrastructure)
+def _create(app_name: str, external_infrastructure: List[str]) -> Dict[str, Any]:
+    return dump_config(create_app(app_name, external_infrastructure))
+
+
+@router.post("", response_model=Job)
+async def create(request: Request) -> Job:
+    return queue.submit(
+        "create_app",
+        request.app_name,
+        _create,
+        request.app_name,
+        request.external_infrastructure,
+    )
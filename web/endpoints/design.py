@@ -3,7 +3,9 @@ from typing import Any, Dict
 from fastapi import APIRouter
 from pydantic import BaseModel, ConfigDict
 
+from utils.architecture import dump_config
 from utils.state import Conversation
+from web.jobs import Job, queue
 from workflows import design
 
 
@@ -22,7 +24,13 @@ class Response(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
 
-@router.post("/chat", response_model=Response)
-async def chat(request: Request) -> Response:
-    config, conversation = design.run(request.app_name, request.user_message)
-    return Response(config=config, conversation=conversation)
+def _chat(app_name: str, user_message: str) -> Dict[str, Any]:
+    config, conversation = design.run(app_name, user_message)
+    return Response(config=dump_config(config), conversation=conversation).model_dump()
+
+
+@router.post("/chat", response_model=Job)
+async def chat(request: Request) -> Job:
+    return queue.submit(
+        "design", request.app_name, _chat, request.app_name, request.user_message
+    )
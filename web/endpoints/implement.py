@@ -4,6 +4,7 @@ from fastapi import APIRouter
 from pydantic import BaseModel
 
 from utils.architecture import ImplementedComponent, load_config
+from web.jobs import Job, queue
 from workflows import implement
 
 router = APIRouter()
@@ -14,6 +15,12 @@ class Request(BaseModel):
     architecture: List[ImplementedComponent] = []
 
 
-@router.post("", response_model=str)
-async def implement_architecture(request: Request) -> str:
-    return implement.run(request.app_name, request.architecture)
+@router.post("", response_model=Job)
+async def implement_architecture(request: Request) -> Job:
+    return queue.submit(
+        "implement",
+        request.app_name,
+        implement.run,
+        request.app_name,
+        request.architecture,
+    )
@@ -0,0 +1,50 @@
+import asyncio
+import json
+from typing import AsyncIterator, Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import StreamingResponse
+
+from web.jobs import Job, JobStatus, queue
+
+router = APIRouter()
+
+POLL_INTERVAL = 0.05
+
+
+@router.get("/{job_id}", response_model=Job)
+async def get_job(job_id: str) -> Job:
+    job = queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+@router.get("/{job_id}/events")
+async def stream_job_events(
+    job_id: str, last_event_id: Optional[int] = Header(default=None)
+) -> StreamingResponse:
+    """Server-sent events with the job's output, as it's printed.
+
+    Each event is named after its kind (`assistant` for generated tokens,
+    `system` for workflow output) and its data is the JSON-encoded text. The
+    stream ends with a `job` event holding the finished job.
+    """
+    job = queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    async def _events() -> AsyncIterator[str]:
+        start = 0 if last_event_id is None else last_event_id + 1
+        while True:
+            finished = job.status in (JobStatus.DONE, JobStatus.FAILED)
+            events = queue.events(job_id, start)
+            for event in events:
+                yield f"id: {event.id}\nevent: {event.kind}\ndata: {json.dumps(event.text)}\n\n"
+            start += len(events)
+            if finished:
+                yield f"event: job\ndata: {job.model_dump_json()}\n\n"
+                return
+            await asyncio.sleep(POLL_INTERVAL)
+
+    return StreamingResponse(_events(), media_type="text/event-stream")
@@ -0,0 +1,26 @@
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter
+
+from ai.usage import ledger, load_reports
+
+router = APIRouter()
+
+
+@router.get("", response_model=Dict[str, Any])
+async def get_usage(
+    app_name: Optional[str] = None, run: Optional[str] = None
+) -> Dict[str, Any]:
+    """Token usage and cost since the server started."""
+    labels = {}
+    if app_name:
+        labels["app"] = app_name
+    if run:
+        labels["run"] = run
+    return ledger.report(**labels)
+
+
+@router.get("/{app_name}/reports", response_model=List[Dict[str, Any]])
+async def get_reports(app_name: str) -> List[Dict[str, Any]]:
+    """The saved report of every implement and fix run of the app."""
+    return load_reports(app_name)
@@ -0,0 +1,157 @@
+import threading
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from enum import Enum
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from utils.io import add_sink, print_system
+
+
+MAX_WORKERS = 4
+MAX_FINISHED_JOBS = 100
+# The finished jobs whose events are kept, which take much more memory
+MAX_FINISHED_EVENT_LOGS = 10
+
+
+class JobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class Job(BaseModel):
+    id: str
+    name: str
+    app_name: str
+    status: JobStatus = JobStatus.PENDING
+    result: Any = None
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+
+class JobEvent(BaseModel):
+    id: int
+    kind: str
+    text: str
+
+
+class _EventLog:
+    """The events of a job. Consecutive output of the same kind, ie, the
+    deltas of a stream, goes into a single event until it's read, so that a
+    job keeps one event per read or per change of kind, not one per delta."""
+
+    def __init__(self) -> None:
+        self._events: List[JobEvent] = []
+        # The events before it were read, so they can't change anymore
+        self._read = 0
+        self._lock = threading.Lock()
+
+    def append(self, kind: str, text: str) -> None:
+        with self._lock:
+            if len(self._events) > self._read and self._events[-1].kind == kind:
+                self._events[-1].text += text
+            else:
+                self._events.append(
+                    JobEvent(id=len(self._events), kind=kind, text=text)
+                )
+
+    def read(self, start: int) -> List[JobEvent]:
+        with self._lock:
+            self._read = max(self._read, len(self._events))
+            return self._events[start:]
+
+
+class JobQueue:
+    """Runs workflows in worker threads, outside of the event loop.
+
+    Jobs of the same app run one at a time, in submission order, since the
+    workflows read and write the app's repo. They wait in a queue per app,
+    without taking a worker, so that they don't hold up the other apps.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._events: Dict[str, _EventLog] = {}
+        # The jobs of each app that wait for its running one
+        self._app_queues: Dict[
+            str, Deque[Tuple[Job, Callable[..., Any], Tuple[Any, ...]]]
+        ] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self, name: str, app_name: str, fn: Callable[..., Any], *args: Any
+    ) -> Job:
+        job = Job(
+            id=uuid.uuid4().hex, name=name, app_name=app_name, created_at=datetime.now()
+        )
+        with self._lock:
+            self._jobs[job.id] = job
+            self._events[job.id] = _EventLog()
+            self._prune()
+            if app_name in self._app_queues:
+                self._app_queues[app_name].append((job, fn, args))
+                return job
+            self._app_queues[app_name] = deque()
+        self._executor.submit(self._run, job, fn, *args)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def events(self, job_id: str, start: int = 0) -> List[JobEvent]:
+        """Everything the job has printed so far, from event `start` on, or
+        nothing once the events of a finished job were dropped."""
+        events = self._events.get(job_id)
+        return [] if events is None else events.read(start)
+
+    def _run(self, job: Job, fn: Callable[..., Any], *args: Any) -> None:
+        # Called from every thread of the workflow
+        with add_sink(self._events[job.id].append):
+            job.status = JobStatus.RUNNING
+            job.started_at = datetime.now()
+            try:
+                job.result = fn(*args)
+                job.status = JobStatus.DONE
+            except Exception as e:
+                print_system(traceback.format_exc())
+                job.error = f"{type(e).__name__}: {e}"
+                job.status = JobStatus.FAILED
+            finally:
+                job.finished_at = datetime.now()
+        self._run_next(job.app_name)
+
+    def _run_next(self, app_name: str) -> None:
+        with self._lock:
+            self._prune()
+            app_queue = self._app_queues[app_name]
+            if not app_queue:
+                del self._app_queues[app_name]
+                return
+            job, fn, args = app_queue.popleft()
+        self._executor.submit(self._run, job, fn, *args)
+
+    def _prune(self) -> None:
+        finished = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.status in (JobStatus.DONE, JobStatus.FAILED)
+        ]
+        for job_id in finished[: max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self._jobs[job_id]
+            self._events.pop(job_id, None)
+        for job_id in finished[: max(len(finished) - MAX_FINISHED_EVENT_LOGS, 0)]:
+            self._events.pop(job_id, None)
+
+
+queue = JobQueue()
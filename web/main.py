@@ -7,6 +7,8 @@ load_dotenv()
 from web.endpoints.create_app import router as create_app_router
 from web.endpoints.design import router as design_router
 from web.endpoints.implement import router as implement_router
+from web.endpoints.jobs import router as jobs_router
+from web.endpoints.usage import router as usage_router
 
 app = FastAPI()
 
@@ -21,3 +23,5 @@ app.add_middleware(
 app.include_router(create_app_router, prefix="/create-app")
 app.include_router(design_router, prefix="/design")
 app.include_router(implement_router, prefix="/implement")
+app.include_router(jobs_router, prefix="/jobs")
+app.include_router(usage_router, prefix="/usage")
@@ -6,7 +6,9 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from ai import llm
-from ai.function_calling import Function
+from ai.function_calling import Function, WrongFunctionOutput
+from ai.usage import usage_scope
+from ai.validators import StreamAborted
 from utils.architecture import (
     Component,
     ImplementedComponent,
@@ -15,18 +17,27 @@ from utils.architecture import (
 )
 from utils.github import repository_exists
 from utils.io import print_system, user_input
-from utils.state import Conversation
+from utils.state import Conversation, get_time_name
 from workflows.helpers import REPOS, build_graph, create_app, visualize_graph
 
 
+# Consecutive responses with malformed arguments before giving up
+MAX_TRIES = 2
+
+
 class UpdateComponent(Function[Component]):
     description = "Adds or updates one sqlalchemymodel or function of the architecture."
 
 
 def run(app_name: str, user_message: str) -> Tuple[Dict[str, Any], Conversation]:
+    with usage_scope(app=app_name, run=get_time_name(), workflow="design"):
+        return _run(app_name, user_message)
+
+
+def _run(app_name: str, user_message: str) -> Tuple[Dict[str, Any], Conversation]:
     config = load_config(app_name)
     conversation = Conversation.load(app_name)
-    architecture = {c.base.root.key: c for c in config["architecture"]}
+    architecture = config["architecture"]
 
     if len(conversation) == 0:
         conversation = Conversation()
@@ -76,7 +87,7 @@ Follow the user's instructions to build the architecture by adding or updating b
         )
 
         raw_architecture = json.dumps(
-            [c.model_dump() for c in architecture.values()], indent=4
+            [c.dump_for_prompt() for c in architecture.values()], indent=4
         )
         conversation.add_user(
             f"Initial architecture:\n\n{raw_architecture}\n"
@@ -85,11 +96,22 @@ Follow the user's instructions to build the architecture by adding or updating b
         )
     conversation.add_user(user_message)
 
+    tries = 0
     while True:
-        next = llm.stream_next(
-            conversation,
-            tools=[UpdateComponent.tool()],
-        )
+        try:
+            next = llm.stream_next(
+                conversation,
+                tools=[UpdateComponent.tool()],
+            )
+        except StreamAborted as e:
+            tries += 1
+            if tries >= MAX_TRIES:
+                raise WrongFunctionOutput(f"Wrong output for {UpdateComponent} :: {e}")
+            conversation.add_user(
+                f"Unable to read the components :: {e}. Please try again."
+            )
+            continue
+        tries = 0
 
         if isinstance(next, llm.RawFunctionParams):
             conversation.add_raw_tool(next)
@@ -132,12 +154,23 @@ Follow the user's instructions to build the architecture by adding or updating b
                     valid_components.append(component)
 
             for component in valid_components:
+                previous = architecture.get(component.key)
                 architecture[component.key] = ImplementedComponent(base=component)
-            config["architecture"] = list(architecture.values())
+                cycle = architecture.graph.find_cycle(component.key)
+                if cycle is not None:
+                    if previous is not None:
+                        architecture[component.key] = previous
+                    else:
+                        architecture.remove(component.key)
+                    invalid_components[component.key] = (
+                        f"Unable to update component :: {component.key} "
+                        f"because it creates a circular dependency :: {' -> '.join(cycle)}. "
+                        "Please try again."
+                    )
             print_system(f"Invalid components: {invalid_components}")
 
             raw_architecture = json.dumps(
-                [c.model_dump() for c in architecture.values()], indent=4
+                [c.dump_for_prompt() for c in architecture.values()], indent=4
             )
             if not invalid_components:
                 tool_response = f"Done. Architecture:\n\n{raw_architecture}"
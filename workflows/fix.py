@@ -1,5 +1,4 @@
 import argparse
-import json
 from typing import Any, Dict
 
 from dotenv import load_dotenv
@@ -7,11 +6,21 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from ai import llm
+from ai.usage import ledger, usage_scope
 from utils.architecture import load_config, save_config
 from utils.io import print_system
-from utils.state import Conversation
-from workflows.helpers import execute_deploy, extract_json
-from workflows.subworkflows import write_component
+from utils.state import get_time_name
+from workflows.helpers import (
+    execute_deploy,
+    extract_json,
+    stop_mypy,
+    stop_sandbox,
+)
+from workflows.subworkflows import (
+    ImplementationContext,
+    start_conversation,
+    write_component,
+)
 
 
 ERROR = """ERROR 2024-12-29T04:06:29.230750Z Traceback (most recent call last): File "/usr/local/lib/python3.13/site-packages/uvicorn/protocols/http/h11_impl.py", line 403, in run_asgi result = await app( # type: ignore[func-returns-value]
@@ -69,19 +78,26 @@ DEFAULT 2024-12-29T04:06:29.230892Z {'type': 'string_type', 'loc': ('response',
 
 
 def run(app_name: str, config: Dict[str, Any]):
-    architecture = {c.base.key: c for c in config["architecture"]}
+    run_id = get_time_name()
+    try:
+        with usage_scope(app=app_name, run=run_id, workflow="fix"):
+            return _run(app_name, config)
+    finally:
+        stop_mypy(app_name)
+        stop_sandbox(app_name)
+        print_system(f"Usage report :: {ledger.save_report(app_name, run_id)}")
 
-    conversation = Conversation()
-    conversation.add_system(
-        """You are a helpful AI assistant that fixes bugs.
+
+def _run(app_name: str, config: Dict[str, Any]):
+    architecture = config["architecture"]
+
+    conversation = start_conversation(
+        architecture,
+        system="""You are a helpful AI assistant that fixes bugs.
 
 Given the log of an error:
 1. Identify the set of files that need to be updated to fix it. Ignore tests.
-2. Make the minimum set of changes to fix it."""
-    )
-
-    conversation.add_user(
-        f"Consider the following python architecture: {json.dumps([c.model_dump() for c in config['architecture']], indent=2)}"
+2. Make the minimum set of changes to fix it.""",
     )
     conversation.add_user(f"Consider the following error:\n\n{ERROR}")
     conversation.add_user("What is the plan to fix this error?")
@@ -102,14 +118,18 @@ Given the log of an error:
     for component in components:
         component_to_fix = architecture[component]
         conversation.add_user(f"Fix :: {component}")
-        output = write_component(app_name, component_to_fix, conversation.copy())
+        output = write_component(
+            app_name,
+            ImplementationContext(component=component_to_fix),
+            config["external_infrastructure"],
+            conversation.copy(),
+        )
 
         conversation.add_assistant(output.assistant_message)
         assert output.component.file
         conversation.add_user(f"I saved the code in {output.component.file.path}.")
         architecture[output.component.base.key].file = output.component.file
 
-        config["architecture"] = list(architecture.values())
         save_config(config)
 
     print_system("Deploying application...")
@@ -1,16 +1,20 @@
+import hashlib
 import json
-import importlib
 import os
 import re
 import subprocess
+import sys
+import threading
 import venv
+from concurrent.futures import Future
 from mypy import api
-from typing import Any, Dict, List, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import matplotlib.pyplot as plt
 import networkx as nx
 
 from utils.architecture import (
+    Architecture,
     Function,
     ImplementedComponent,
     SQLAlchemyModel,
@@ -22,9 +26,11 @@ from utils.github import (
     protect_repository,
     repository_exists,
 )
+from utils.dependency_graph import DependencyGraph
 from utils.io import print_system
 from utils.state import Conversation
 from utils.static_analysis import extract_router_name, extract_sqlalchemy_models
+from workflows.sandbox import Sandbox, SandboxError
 
 
 REPOS = os.path.expanduser("~/repos")
@@ -58,17 +64,8 @@ def visualize_graph(G: nx.DiGraph, *, figsize=(12, 12), k=0.15, iterations=20):
     plt.show()
 
 
-def build_graph(architecture: List[ImplementedComponent]) -> nx.DiGraph:
-    G = nx.DiGraph()
-    for component in architecture:
-        G.add_node(component.base.key)
-        if isinstance(component.base.root, SQLAlchemyModel):
-            for dependency in component.base.root.associations:
-                G.add_edge(component.base.key, dependency)
-        elif isinstance(component.base.root, Function):
-            for dependency in component.base.root.uses:
-                G.add_edge(component.base.key, dependency)
-    return G
+def build_graph(architecture: Architecture) -> nx.DiGraph:
+    return architecture.graph.to_networkx()
 
 
 def create_app(app_name: str, external_infrastructure: List[str]) -> Dict[str, Any]:
@@ -110,32 +107,174 @@ class InstallRequirementsError(Exception):
     pass
 
 
+# Shared by the venvs of all apps
+WHEELHOUSE = f"{REPOS}/.wheelhouse"
+PIP_CACHE = f"{REPOS}/.pip-cache"
+
+
+def get_venv_python(app_name: str) -> str:
+    return f"{REPOS}/{app_name}/venv/bin/python3"
+
+
+def _package_name(requirement: str) -> str:
+    return re.split(r"[<>=!~\[;\s]", requirement, maxsplit=1)[0].lower()
+
+
+def _pip(venv_python: str, *args: str) -> subprocess.CompletedProcess:
+    output = subprocess.run(
+        [venv_python, "-m", "pip", *args, "--cache-dir", PIP_CACHE],
+        check=False,
+        capture_output=True,
+        text=True,
+    )
+    print_system(output.stdout)
+    print_system(output.stderr)
+    return output
+
+
+def _canonical_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _unneeded(venv_python: str, packages: Set[str]) -> List[str]:
+    """The installed `packages` that no other installed package requires,
+    apart from each other, since pip uninstalls them regardless."""
+    output = subprocess.run(
+        [venv_python, "-m", "pip", "show", *sorted(packages)],
+        check=False,
+        capture_output=True,
+        text=True,
+    )
+    required_by: Dict[str, Set[str]] = {}
+    for block in output.stdout.split("\n---\n"):
+        fields = dict(
+            line.split(": ", 1) for line in block.splitlines() if ": " in line
+        )
+        if "Name" in fields:
+            required_by[_canonical_name(fields["Name"])] = {
+                _canonical_name(name)
+                for name in fields.get("Required-by", "").split(",")
+                if name.strip()
+            }
+    unneeded = set(required_by)
+    while True:
+        needed = {p for p in unneeded if required_by[p] - unneeded}
+        if not needed:
+            return sorted(unneeded)
+        unneeded -= needed
+
+
 def install_requirements(
     app_name: str,
-    architecture: List[ImplementedComponent],
+    architecture: Architecture,
 ) -> None:
+    """Brings the app's venv up to date with the requirements of the
+    architecture, only installing or removing what changed since last time.
+
+    Packages are installed from a wheelhouse shared by all apps, which is only
+    filled from the package index when a package is missing from it.
+    """
     pypi_packages = set()
     for component in architecture:
         pypi_packages.update(component.base.root.pypi_packages)
+    requirements = sorted(pypi_packages)
     requirements_path = f"{REPOS}/{app_name}/requirements.txt"
     with open(requirements_path, "w") as f:
-        f.write("\n".join(pypi_packages))
+        f.write("\n".join(requirements))
+    requirements_hash = hashlib.sha256("\n".join(requirements).encode()).hexdigest()
 
     venv_path = f"{REPOS}/{app_name}/venv"
-    os.makedirs(venv_path, exist_ok=True)
-    venv.create(venv_path, with_pip=True)
-    venv_python = os.path.join(venv_path, "bin", "python3")
+    venv_python = get_venv_python(app_name)
+    # What was installed from the requirements, the last time that it succeeded
+    state_path = os.path.join(venv_path, "requirements.json")
+    installed: List[str] = []
+    if os.path.exists(venv_python):
+        if os.path.exists(state_path):
+            with open(state_path, "r") as f:
+                state = json.load(f)
+            if state["hash"] == requirements_hash:
+                print_system("Requirements are up to date")
+                return
+            installed = state["requirements"]
+    else:
+        os.makedirs(venv_path, exist_ok=True)
+        venv.create(venv_path, with_pip=True)
+
     print_system("Installing requirements...")
-    output = subprocess.run(
-        [venv_python, "-m", "pip", "install", "-r", requirements_path],
-        check=False,
-        capture_output=True,
-        text=True,
-    )
-    print_system(output.stdout)
-    print_system(output.stderr)
-    if output.returncode != 0:
-        raise Exception(f"{output.stdout}\n{output.stderr}")
+    removed = {_package_name(r) for r in installed} - {
+        _package_name(r) for r in requirements
+    }
+    # The ones that the remaining requirements still need stay installed
+    removed_unneeded = _unneeded(venv_python, removed) if removed else []
+    if removed_unneeded:
+        output = _pip(venv_python, "uninstall", "-y", *removed_unneeded)
+        if output.returncode != 0:
+            raise InstallRequirementsError(f"{output.stdout}\n{output.stderr}")
+
+    added = [r for r in requirements if r not in installed]
+    if added:
+        offline_install = ["install", "--no-index", "--find-links", WHEELHOUSE]
+        output = _pip(venv_python, *offline_install, *added)
+        if output.returncode != 0:
+            os.makedirs(WHEELHOUSE, exist_ok=True)
+            output = _pip(
+                venv_python,
+                "wheel",
+                "--wheel-dir",
+                WHEELHOUSE,
+                "--find-links",
+                WHEELHOUSE,
+                *added,
+            )
+            if output.returncode == 0:
+                output = _pip(venv_python, *offline_install, *added)
+        if output.returncode != 0:
+            output = _pip(venv_python, "install", "--find-links", WHEELHOUSE, *added)
+        if output.returncode != 0:
+            raise InstallRequirementsError(f"{output.stdout}\n{output.stderr}")
+
+    with open(state_path, "w") as f:
+        json.dump({"hash": requirements_hash, "requirements": requirements}, f)
+
+
+# Previous generations of the components of all apps, by closure hash
+GENERATIONS = f"{REPOS}/.generations"
+
+
+def load_generation(app_name: str, closure_hash: str) -> Optional[str]:
+    path = f"{GENERATIONS}/{app_name}/{closure_hash}.py"
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return f.read()
+
+
+def save_generation(app_name: str, closure_hash: str, code: str) -> None:
+    os.makedirs(f"{GENERATIONS}/{app_name}", exist_ok=True)
+    with open(f"{GENERATIONS}/{app_name}/{closure_hash}.py", "w") as f:
+        f.write(code)
+
+
+# Seconds that it took to implement each component of each app, on average
+LATENCIES = f"{REPOS}/.latencies"
+
+
+def load_latencies(app_name: str) -> Dict[str, float]:
+    path = f"{LATENCIES}/{app_name}.json"
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_latencies(app_name: str, latencies: Dict[str, float]) -> None:
+    """Averages them with the ones of previous runs."""
+    averages = load_latencies(app_name)
+    for key, latency in latencies.items():
+        averages[key] = (averages[key] + latency) / 2 if key in averages else latency
+    os.makedirs(LATENCIES, exist_ok=True)
+    with open(f"{LATENCIES}/{app_name}.json", "w") as f:
+        json.dump(averages, f, indent=2, sort_keys=True)
 
 
 def create_folders_if_not_exist(app_name: str, namespace: str) -> None:
@@ -154,34 +293,13 @@ def create_folders_if_not_exist(app_name: str, namespace: str) -> None:
 def group_nodes_by_dependencies(
     architecture: List[ImplementedComponent],
 ) -> List[Set[str]]:
-    levels = []
-    dependencies = {}
-    for component in architecture:
-        if isinstance(component.base.root, SQLAlchemyModel):
-            dependencies[component.base.root.key] = component.base.root.associations
-        elif isinstance(component.base.root, Function):
-            dependencies[component.base.root.key] = component.base.root.uses
-
-    remaining_components = set(dependencies.keys())
-    while remaining_components:
-        current_level = {
-            component
-            for component in remaining_components
-            if all(dep not in remaining_components for dep in dependencies[component])
-        }
-
-        if not current_level:
-            raise ValueError("Circular dependency detected")
-
-        levels.append(current_level)
-        remaining_components -= current_level
-
-    return levels
+    """Raises CircularDependencyError, naming the cycle."""
+    return DependencyGraph.from_components(architecture).levels()
 
 
 def update_main(
     app_name: str,
-    architecture: List[ImplementedComponent],
+    architecture: Architecture,
     external_infrastructure,
 ) -> None:
     with open(f"{REPOS}/{app_name}/app/main.py", "r") as f:
@@ -213,62 +331,215 @@ def update_main(
 
 
 def execute_deploy(app_name: str) -> str:
-    original_dir = os.getcwd()
-    try:
-        os.chdir(f"{REPOS}/{app_name}")
-        subprocess.run(["chmod", "+x", "deploy.sh"], check=True)
-        output = subprocess.run(
-            ["./deploy.sh", app_name], check=True, capture_output=True, text=True
-        )
-        print_system(output.stdout)
-        print_system(output.stderr)
-        return output.stdout.splitlines()[-1]
-    finally:
-        os.chdir(original_dir)
+    # No os.chdir: workflows run concurrently in the same process
+    app_dir = f"{REPOS}/{app_name}"
+    subprocess.run(["chmod", "+x", "deploy.sh"], check=True, cwd=app_dir)
+    output = subprocess.run(
+        ["./deploy.sh", app_name],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=app_dir,
+    )
+    print_system(output.stdout)
+    print_system(output.stderr)
+    return output.stdout.splitlines()[-1]
 
 
 class ModelImplementationError(Exception):
     pass
 
 
-def create_tables(app_name: str, namespace: str, code: str) -> None:
-    from sqlalchemy import create_engine
-    from sqlalchemy.schema import MetaData
-    from sqlalchemy.ext.declarative import declarative_base
+_sandboxes: Dict[str, Sandbox] = {}
+_sandboxes_lock = threading.Lock()
+
+
+def get_sandbox(app_name: str) -> Sandbox:
+    with _sandboxes_lock:
+        if app_name not in _sandboxes:
+            _sandboxes[app_name] = Sandbox(
+                get_venv_python(app_name), f"{REPOS}/{app_name}"
+            )
+        return _sandboxes[app_name]
+
 
-    metadata = MetaData()
-    Base = declarative_base(metadata=metadata)
+def stop_sandbox(app_name: str) -> None:
+    with _sandboxes_lock:
+        sandbox = _sandboxes.pop(app_name, None)
+    if sandbox is not None:
+        sandbox.close()
+
+
+def create_tables(
+    app_name: str, namespace: str, code: str, module: Optional[str] = None
+) -> None:
+    """Creates the tables of the models in `code` in a sandbox, since it
+    imports the generated code. The code is in `module`, or else in the
+    module of each model, in `namespace`."""
     models = extract_sqlalchemy_models(code)
-    test_engine = create_engine(
-        f"sqlite:///file:{app_name}?mode=memory&cache=shared&uri=true"
-    )
-    for model in models:
-        module_path = f"app.{namespace}.{model}"
-        models_module = importlib.import_module(module_path)
-        model_class = getattr(models_module, model)
-        if hasattr(model_class, "__table__"):
-            model_class.__table__ = None
-        model_class.metadata.clear()
-        model_class.__bases__ = (Base,)
+    folder = f"{REPOS}/{app_name}/app/{namespace.replace('.', '/')}"
+    # Without the models' own modules, that would define their tables twice
+    siblings = [
+        f"app.{namespace}.{name[:-3]}"
+        for name in sorted(os.listdir(folder))
+        if name.endswith(".py") and name != "__init__.py" and name[:-3] not in models
+    ]
     try:
-        metadata.create_all(bind=test_engine)
-    except Exception as e:
-        raise ModelImplementationError(f"Error creating tables: {e}")
+        error = get_sandbox(app_name).run(
+            "create_tables",
+            models=[[module or f"app.{namespace}.{model}", model] for model in models],
+            siblings=siblings,
+        )
+    except SandboxError as e:
+        error = str(e)
+    if error:
+        raise ModelImplementationError(f"Error creating tables: {error}")
+
+
+class ModuleImportError(Exception):
+    pass
+
+
+def import_module(app_name: str, module: str) -> None:
+    """Imports `module` in a sandbox, which runs the code at its top level,
+    ie, what mypy doesn't."""
+    try:
+        error = get_sandbox(app_name).run("import_module", module=module)
+    except SandboxError as e:
+        error = str(e)
+    if error:
+        raise ModuleImportError(f"Error importing {module}: {error}")
 
 
 class MypyError(Exception):
     pass
 
 
-def run_mypy(file_path: str) -> None:
-    stdout, stderr, exit_code = api.run(
+MYPY_FLAGS = [
+    "--disable-error-code=import-untyped",
+    "--disable-error-code=call-overload",
+]
+# Outside of the apps' repos, so that they aren't committed
+DMYPY = f"{REPOS}/.dmypy"
+
+_mypy_locks: Dict[str, threading.Lock] = {}
+_mypy_locks_lock = threading.Lock()
+
+
+def _mypy_lock(app_name: str) -> threading.Lock:
+    with _mypy_locks_lock:
+        return _mypy_locks.setdefault(app_name, threading.Lock())
+
+
+def _dmypy(app_name: str, *args: str) -> subprocess.CompletedProcess:
+    os.makedirs(DMYPY, exist_ok=True)
+    return subprocess.run(
         [
-            file_path,
-            "--disable-error-code=import-untyped",
-            "--disable-error-code=call-overload",
-        ]
+            sys.executable,
+            "-m",
+            "mypy.dmypy",
+            "--status-file",
+            f"{DMYPY}/{app_name}.json",
+            *args,
+        ],
+        check=False,
+        capture_output=True,
+        text=True,
+        cwd=f"{REPOS}/{app_name}",
     )
+
+
+# Files waiting for the next check of their app, with the future of their errors
+_mypy_pending: Dict[str, List[Tuple[str, "Future[str]"]]] = {}
+
+_MYPY_MESSAGE = re.compile(r"^(?P<path>[^:\s][^:]*\.pyi?):\d+(?::\d+)?: \w+:")
+
+
+def _split_mypy_output(
+    output: str, cwd: str, file_paths: List[str]
+) -> Optional[Dict[str, str]]:
+    """The messages about each of `file_paths`, or None if the output has no
+    messages at all, ie, mypy crashed. Messages about other files, ie, about
+    already implemented imports, are dropped."""
+    messages: Dict[str, List[str]] = {path: [] for path in file_paths}
+    found = False
+    path = None
+    for line in output.splitlines():
+        match = _MYPY_MESSAGE.match(line)
+        if match:
+            found = True
+            path = os.path.abspath(os.path.join(cwd, match["path"]))
+        elif line.startswith(("Found ", "Success: ")):
+            path = None
+        if path in messages:
+            messages[path].append(line)
+    if not found:
+        return None
+    return {path: "\n".join(lines) for path, lines in messages.items() if lines}
+
+
+def _run_mypy_batch(app_name: str, file_paths: List[str]) -> Dict[str, str]:
+    args = [
+        *MYPY_FLAGS,
+        f"--python-executable={get_venv_python(app_name)}",
+        f"--cache-dir={DMYPY}/{app_name}_cache",
+        *file_paths,
+    ]
+    output = _dmypy(app_name, "run", "--timeout", "3600", "--", *args)
+    stdout, stderr, exit_code = output.stdout, output.stderr, output.returncode
+    # Relative paths in the output are relative to the daemon's directory
+    cwd = f"{REPOS}/{app_name}"
+    if exit_code == 2:
+        # The daemon failed, not the check. Fall back to a one-off run
+        print_system(f"{stdout}\n{stderr}")
+        _dmypy(app_name, "kill")
+        stdout, stderr, exit_code = api.run(args)
+        cwd = os.getcwd()
     print_system(stdout)
     print_system(stderr)
-    if exit_code != 0:
-        raise MypyError(f"{stdout}\n{stderr}")
+    if exit_code == 0:
+        return {}
+    errors = _split_mypy_output(stdout, cwd, file_paths)
+    if errors is None:
+        return {path: f"{stdout}\n{stderr}" for path in file_paths}
+    return errors
+
+
+def run_mypy(app_name: str, file_path: str) -> None:
+    """Checks the file with the app's mypy daemon, which is started by the
+    first check. The daemon keeps the types of the app and its packages in
+    memory, so each check only rechecks what changed.
+
+    Concurrent calls are batched: the files that are queued while a check
+    runs are all checked by the next one, and each call raises with the
+    errors of its own file only. Installed packages are resolved from the
+    app's venv.
+    """
+    file_path = os.path.abspath(file_path)
+    future: Future[str] = Future()
+    with _mypy_locks_lock:
+        _mypy_pending.setdefault(app_name, []).append((file_path, future))
+
+    # A daemon checks one set of files at a time
+    with _mypy_lock(app_name):
+        # Otherwise, it was checked with the batch of another call
+        if not future.done():
+            with _mypy_locks_lock:
+                batch = _mypy_pending.pop(app_name)
+            try:
+                errors = _run_mypy_batch(app_name, sorted({path for path, _ in batch}))
+            except Exception as e:
+                for _, pending in batch:
+                    pending.set_exception(e)
+            else:
+                for path, pending in batch:
+                    pending.set_result(errors.get(path, ""))
+
+    file_errors = future.result()
+    if file_errors:
+        raise MypyError(file_errors)
+
+
+def stop_mypy(app_name: str) -> None:
+    with _mypy_lock(app_name):
+        _dmypy(app_name, "stop")
@@ -1,151 +1,394 @@
-import json
 import argparse
-from concurrent.futures import ThreadPoolExecutor
-from typing import List
+import heapq
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from typing import Dict, List, NoReturn, Optional, Set, Tuple
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
 from ai import llm
+from ai.usage import ledger, usage_scope
 from utils.architecture import (
-    Function,
+    Architecture,
     ImplementedComponent,
-    SQLAlchemyModel,
     load_config,
     save_config,
-    update_architecture_diff,
 )
+from utils.dependency_graph import DependencyGraph
 from utils.github import execute_git_commands, revert_changes
 from utils.io import print_system
-from utils.state import Conversation
+from utils.state import Conversation, get_time_name
 from workflows.helpers import (
     MypyError,
+    REPOS,
     execute_deploy,
-    group_nodes_by_dependencies,
     install_requirements,
+    load_generation,
+    load_latencies,
+    save_generation,
+    save_latencies,
+    stop_mypy,
+    stop_sandbox,
     update_main,
 )
 from workflows.subworkflows import (
     ImplementationContext,
     save_templates,
+    start_conversation,
     write_component,
 )
 
+MAX_WORKERS = 10
+MAX_TRIES = 3
+RETRY_BACKOFF = 1.0
+# Versions of the code generated at the same time for each component
+CANDIDATES = 1
+# Seconds to implement a component, without previous runs to estimate it
+DEFAULT_LATENCY = 30.0
 
-def run(app_name: str, new_architecture: List[ImplementedComponent]) -> str:
-    config = load_config(app_name)
-    saved_architecture = config["architecture"]
 
-    whole_architecture = saved_architecture.copy()
-    update_architecture_diff(whole_architecture, new_architecture)
+def _implement_components(
+    app_name: str,
+    architecture_to_update: Dict[str, ImplementedComponent],
+    external_infrastructure: List[str],
+    conversation: Conversation,
+    *,
+    max_tries: int = MAX_TRIES,
+    retry_backoff: float = RETRY_BACKOFF,
+    environment: Optional["Future[None]"] = None,
+    codes: Optional[Dict[str, str]] = None,
+    kept: Optional[Set[str]] = None,
+    candidates: int = CANDIDATES,
+) -> None:
+    """Implements each component as soon as all of its dependencies are done.
 
-    conversation = Conversation()
-    raw_architecture = [c.model_dump() for c in whole_architecture]
-    conversation.add_user(
-        f"Consider the following python architecture: {json.dumps(raw_architecture, indent=2)}"
-    )
+    Dependencies outside of `architecture_to_update` are already implemented.
+    All components share one pool of workers, so a slow component only delays
+    the components that depend on it. A failed attempt is resubmitted to the
+    same pool after `retry_backoff * 2 ** (tries - 1)` seconds, until the
+    component has been tried `max_tries` times.
 
-    save_templates(app_name, saved_architecture, conversation)
-    install_requirements(app_name, whole_architecture)
+    The components in `codes` are first validated with that code, and only
+    generated if it fails, except for the `kept` ones, ie, files that were
+    implemented before. Those are never generated: if they fail, they're kept
+    with a warning. Each generation makes `candidates` versions of the code,
+    and keeps the first one that passes the checks.
+    """
+    codes = codes or {}
+    kept = kept or set()
+    graph = DependencyGraph.from_components(architecture_to_update.values())
+    graph.check_acyclic()
+    remaining_dependencies = {key: graph.dependencies(key) for key in graph}
 
-    architecture_to_update = {}
-    for component in saved_architecture:
-        if not component.file:
-            print_system(f"Will update :: {component.base.key}")
-            architecture_to_update[component.base.key] = component
-    for new_component in new_architecture:
-        for old_component in saved_architecture:
-            if (
-                new_component.base.key == old_component.base.key
-                and new_component.base.root != old_component.base.root
-            ):
-                print_system(f"Will update :: {new_component.base.key}")
-                architecture_to_update[new_component.base.key] = new_component
-                break
-    print_system()
-
-    models_to_parallelize = group_nodes_by_dependencies(
-        [
-            m
-            for m in architecture_to_update.values()
-            if isinstance(m.base.root, SQLAlchemyModel)
-        ]
-    )
-    functions_to_parallelize = group_nodes_by_dependencies(
-        [
-            f
-            for f in architecture_to_update.values()
-            if isinstance(f.base.root, Function)
-        ]
-    )
-    for level in models_to_parallelize + functions_to_parallelize:
-        print_system(f"Implementing :: {level}\n")
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            outputs = list(
-                executor.map(
-                    write_component,
-                    [app_name] * len(level),
-                    [
-                        ImplementationContext(component=architecture_to_update[l])
-                        for l in level
-                    ],
-                    [config["external_infrastructure"]] * len(level),
-                    [conversation.copy() for _ in level],
-                )
-            )
+    latencies = _estimate_latencies(app_name, graph)
+    downstream = graph.downstream_lengths(latencies)
+    critical_path = graph.critical_path(latencies)
+    if critical_path:
+        print_system(
+            f"Critical path :: {' -> '.join(critical_path)} "
+            f"(~{downstream[critical_path[0]]:.0f}s)"
+        )
 
-        def _update(context: ImplementationContext) -> None:
-            assert (
-                context.user_message
-                and context.assistant_message
-                and context.component.file
-            )
-            conversation.add_user(context.user_message)
+    def _update(context: ImplementationContext) -> None:
+        assert context.user_message and context.component.file
+        conversation.add_user(context.user_message)
+        if context.assistant_message:
             conversation.add_assistant(context.assistant_message)
-            conversation.add_user(f"I saved the code in {context.component.file.path}.")
-            architecture_to_update[context.component.base.key].file = (
-                context.component.file
+        conversation.add_user(f"I saved the code in {context.component.file.path}.")
+        architecture_to_update[context.component.base.key].file = context.component.file
+
+    # (priority, key, context) of the attempts that can start. The components
+    # with the longest chain of dependents go first, then the ones with the
+    # most dependents, so that the long chains don't start last.
+    ready: List[Tuple[Tuple[float, int], str, ImplementationContext]] = []
+
+    def _ready(key: str, context: ImplementationContext) -> None:
+        priority = (-downstream[key], -len(graph.dependents(key)))
+        heapq.heappush(ready, (priority, key, context))
+
+    for key, dependencies in remaining_dependencies.items():
+        if not dependencies:
+            _ready(
+                key,
+                ImplementationContext(
+                    component=architecture_to_update[key], code=codes.get(key)
+                ),
             )
+    # Conversation of each component, to which its failed attempts are appended
+    conversations: Dict[str, Conversation] = {}
+    # (due time, key, context) of the attempts waiting for their backoff
+    retries: List[Tuple[float, str, ImplementationContext]] = []
+    running: Dict[Future[ImplementationContext], str] = {}
+    # Seconds that the LLM took to generate each component, over its attempts
+    measured: Dict[str, float] = {}
 
-        correct_implementations = [o for o in outputs if not o.error]
-        wrong_implementations = [o for o in outputs if o.error]
-        for output in correct_implementations:
-            _update(output)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
 
-        if not wrong_implementations:
-            continue
+        def _submit(key: str, context: ImplementationContext) -> None:
+            if key not in conversations:
+                print_system(f"Implementing :: {key}")
+                conversations[key] = conversation.copy()
+            else:
+                print_system(f"Retrying :: {key} (try {context.tries + 1})")
+            # Carries the output sinks of the caller into the worker
+            future = executor.submit(
+                copy_context().run,
+                write_component,
+                app_name,
+                context,
+                external_infrastructure,
+                conversations[key].copy(),
+                environment,
+                candidates,
+            )
+            running[future] = key
+
+        def _abort(error: BaseException) -> NoReturn:
+            for pending in running:
+                pending.cancel()
+            wait(running)
+            revert_changes(app_name)
+            raise error
 
-        for output in wrong_implementations:
-            error_conversation = conversation.copy()
-            while True:
-                assert output.user_message and output.assistant_message
-                error_conversation.add_user(output.user_message)
-                error_conversation.add_assistant(output.assistant_message)
-                error_conversation.add_user(
-                    f"Found the following errors ::\n\n{output.error}"
-                )
-                output = write_component(
-                    app_name,
-                    output,
-                    config["external_infrastructure"],
-                    error_conversation.copy(),
-                )
-                if not output.error:
-                    _update(output)
-                    break
-                if output.tries == 3:
-                    if not isinstance(output.error, MypyError):
-                        assert output.error
-                        revert_changes(app_name)
-                        raise output.error
+        while ready or running or retries:
+            while retries and retries[0][0] <= time.monotonic():
+                _, key, context = heapq.heappop(retries)
+                _ready(key, context)
+            # Only as many as there are workers, so that the priorities hold
+            while ready and len(running) < MAX_WORKERS:
+                _, key, context = heapq.heappop(ready)
+                _submit(key, context)
+
+            timeout = retries[0][0] - time.monotonic() if retries else None
+            if not running:
+                time.sleep(max(timeout or 0, 0))
+                continue
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                try:
+                    context = future.result()
+                except Exception as e:
+                    _abort(e)
+                if context.generation_time:
+                    measured[key] = measured.get(key, 0.0) + context.generation_time
+
+                if context.error and key in kept:
+                    print_system(
+                        f"!!!!! WARNING: Keeping :: {key}, update it by hand ::"
+                        f"\n\n{context.error}"
+                    )
+                elif context.error and context.tries < max_tries:
+                    assert context.user_message
+                    conversations[key].add_user(context.user_message)
+                    if context.assistant_message:
+                        conversations[key].add_assistant(context.assistant_message)
+                    conversations[key].add_user(
+                        f"Found the following errors ::\n\n{context.error}"
+                    )
+                    due = time.monotonic() + retry_backoff * 2 ** (context.tries - 1)
+                    heapq.heappush(retries, (due, key, context))
+                    continue
+                elif context.error:
+                    if not isinstance(context.error, MypyError):
+                        _abort(context.error)
                     print_system(
-                        f"!!!!! WARNING: Letting mypy pass ::\n\n{output.error}"
+                        f"!!!!! WARNING: Letting mypy pass ::\n\n{context.error}"
                     )
-                    _update(output)
-                    break
 
-    update_architecture_diff(saved_architecture, list(architecture_to_update.values()))
+                _update(context)
+                for dependent in graph.dependents(key):
+                    remaining_dependencies[dependent].discard(key)
+                    if not remaining_dependencies[dependent]:
+                        _ready(
+                            dependent,
+                            ImplementationContext(
+                                component=architecture_to_update[dependent],
+                                code=codes.get(dependent),
+                            ),
+                        )
+
+    save_latencies(app_name, measured)
+
+
+def _estimate_latencies(app_name: str, graph: DependencyGraph) -> Dict[str, float]:
+    """From previous runs. Components without any take the median of the app,
+    or DEFAULT_LATENCY."""
+    history = load_latencies(app_name)
+    known = sorted(history.values())
+    default = known[len(known) // 2] if known else DEFAULT_LATENCY
+    return {key: history.get(key, default) for key in graph}
+
+
+def _keep_implementations(
+    saved_architecture: Architecture,
+    new_architecture: List[ImplementedComponent],
+) -> List[ImplementedComponent]:
+    """The new components, with the files and hashes of the saved ones, so
+    that the hashes tell whether they changed."""
+    kept = []
+    for component in new_architecture:
+        old_component = saved_architecture.get(component.base.key)
+        if old_component is not None and old_component.file and not component.file:
+            component = component.model_copy(
+                update={
+                    "file": old_component.file,
+                    "spec_hash": old_component.spec_hash,
+                    "dependency_hashes": old_component.dependency_hashes,
+                    "file_hash": old_component.file_hash,
+                }
+            )
+        kept.append(component)
+    return kept
+
+
+def _plan_updates(
+    app_name: str, architecture: Architecture
+) -> Tuple[Dict[str, ImplementedComponent], Dict[str, str], Set[str]]:
+    """The components to update, the code to validate for the ones that
+    don't need to be generated, and the ones whose files are kept as is.
+
+    A component is generated if it's new, or if its spec or the spec of one of
+    its dependencies changed since its file was generated, unless a previous
+    generation from the same specs can be reused. Its transitive dependents
+    and the files that were edited by hand are only revalidated, and kept.
+    """
+    spec_hashes = {c.base.key: c.current_spec_hash() for c in architecture}
+
+    to_update: Dict[str, ImplementedComponent] = {}
+    codes: Dict[str, str] = {}
+    kept: Set[str] = set()
+    for component in architecture:
+        key = component.base.key
+        if component.file and (
+            component.spec_hash is None
+            or component.closure_hash() == component.closure_hash(spec_hashes)
+        ):
+            continue
+        print_system(f"Will update :: {key}")
+        to_update[key] = component
+        code = load_generation(app_name, component.closure_hash(spec_hashes))
+        if code is not None:
+            print_system(f"Will reuse a previous generation :: {key}")
+            codes[key] = code
+
+    to_revalidate = list(to_update)
+    for component in architecture:
+        key = component.base.key
+        if key in to_update or not component.file:
+            continue
+        path = f"{REPOS}/{app_name}/{component.file.path}"
+        if not os.path.exists(path):
+            codes[key] = component.file.content
+        else:
+            with open(path, "r") as f:
+                content = f.read()
+            if not component.file_changed(content):
+                continue
+            codes[key] = content
+        print_system(f"Will revalidate :: {key}")
+        to_update[key] = component
+        kept.add(key)
+        to_revalidate.append(key)
+    while to_revalidate:
+        for dependent in sorted(architecture.used_by(to_revalidate.pop())):
+            if dependent in to_update:
+                continue
+            component = architecture[dependent]
+            assert component.file
+            print_system(f"Will revalidate :: {dependent}")
+            to_update[dependent] = component
+            codes[dependent] = component.file.content
+            kept.add(dependent)
+            to_revalidate.append(dependent)
+    return to_update, codes, kept
+
+
+def run(
+    app_name: str,
+    new_architecture: List[ImplementedComponent],
+    *,
+    max_tries: int = MAX_TRIES,
+    retry_backoff: float = RETRY_BACKOFF,
+    candidates: int = CANDIDATES,
+) -> str:
+    run_id = get_time_name()
+    try:
+        with usage_scope(app=app_name, run=run_id, workflow="implement"):
+            return _run(
+                app_name, new_architecture, max_tries, retry_backoff, candidates
+            )
+    finally:
+        stop_mypy(app_name)
+        stop_sandbox(app_name)
+        print_system(f"Usage report :: {ledger.save_report(app_name, run_id)}")
+
+
+def _run(
+    app_name: str,
+    new_architecture: List[ImplementedComponent],
+    max_tries: int,
+    retry_backoff: float,
+    candidates: int,
+) -> str:
+    config = load_config(app_name)
+    saved_architecture = config["architecture"]
+    spec_hashes = {c.base.key: c.current_spec_hash() for c in saved_architecture}
+    for component in saved_architecture:
+        # Implemented before the hashes were recorded
+        if component.file and component.spec_hash is None:
+            component.record_hashes(spec_hashes)
+
+    whole_architecture = saved_architecture.copy()
+    whole_architecture.update(
+        _keep_implementations(saved_architecture, new_architecture)
+    )
+
+    conversation = start_conversation(whole_architecture)
+
+    save_templates(app_name, saved_architecture, conversation)
+    # Only the validation of the code needs the venv, not its generation
+    setup = ThreadPoolExecutor(max_workers=1)
+    environment = setup.submit(
+        copy_context().run, install_requirements, app_name, whole_architecture
+    )
+    setup.shutdown(wait=False)
+
+    try:
+        architecture_to_update, codes, kept = _plan_updates(
+            app_name, whole_architecture
+        )
+        print_system()
+
+        _implement_components(
+            app_name,
+            architecture_to_update,
+            config["external_infrastructure"],
+            conversation,
+            max_tries=max_tries,
+            retry_backoff=retry_backoff,
+            environment=environment,
+            codes=codes,
+            kept=kept,
+            candidates=candidates,
+        )
+        environment.result()
+    finally:
+        # Even if the run failed, so that the next job of the app doesn't
+        # install into the venv at the same time
+        wait([environment])
+
+    spec_hashes = {c.base.key: c.current_spec_hash() for c in whole_architecture}
+    for component in architecture_to_update.values():
+        assert component.file
+        component.record_hashes(spec_hashes)
+        if component.base.key not in kept:
+            save_generation(app_name, component.closure_hash(), component.file.content)
+    saved_architecture.update(architecture_to_update.values())
     update_main(app_name, saved_architecture, config["external_infrastructure"])
 
     conversation.add_user("Give me a one line commit message for the changes. Go: ...")
@@ -171,6 +414,15 @@ def run(app_name: str, new_architecture: List[ImplementedComponent]) -> str:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("app")
+    parser.add_argument("--max-tries", type=int, default=MAX_TRIES)
+    parser.add_argument("--retry-backoff", type=float, default=RETRY_BACKOFF)
+    parser.add_argument("--candidates", type=int, default=CANDIDATES)
     args = parser.parse_args()
 
-    run(args.app, [])
+    run(
+        args.app,
+        [],
+        max_tries=args.max_tries,
+        retry_backoff=args.retry_backoff,
+        candidates=args.candidates,
+    )
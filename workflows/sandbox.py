@@ -0,0 +1,97 @@
+import json
+import os
+import select
+import subprocess
+import threading
+from typing import Any, List, Optional
+
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py")
+MAX_WORKERS = 4
+TIMEOUT = 60.0
+
+
+class SandboxError(Exception):
+    pass
+
+
+class _Worker:
+    def __init__(self, python: str, app_dir: str):
+        self.process = subprocess.Popen(
+            [python, "-u", WORKER, app_dir],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            # A retry can rewrite a module within the same second, with the
+            # same size, which a cached .pyc wouldn't notice
+            env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        )
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def request(self, request: dict, timeout: float) -> Optional[str]:
+        assert self.process.stdin and self.process.stdout
+        try:
+            self.process.stdin.write(json.dumps(request) + "\n")
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            raise SandboxError(f"Worker exited with code {self.process.wait()}")
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+        if not ready:
+            raise SandboxError(f"Check timed out after {timeout}s")
+        line = self.process.stdout.readline()
+        if not line:
+            raise SandboxError(f"Check crashed with exit code {self.process.wait()}")
+        return json.loads(line)["error"]
+
+    def close(self) -> None:
+        self.process.kill()
+        self.process.wait()
+
+
+class Sandbox:
+    """Pool of warm worker processes that import and run generated code,
+    instead of the orchestrator, with the app's venv.
+
+    Each check starts from a clean slate of the app's modules, so a retry
+    sees the code that was just written. A worker that crashes or times out
+    is replaced.
+    """
+
+    def __init__(
+        self,
+        python: str,
+        app_dir: str,
+        *,
+        max_workers: int = MAX_WORKERS,
+        timeout: float = TIMEOUT,
+    ):
+        self.python = python
+        self.app_dir = app_dir
+        self.timeout = timeout
+        self._idle: List[_Worker] = []
+        self._slots = threading.Semaphore(max_workers)
+        self._lock = threading.Lock()
+
+    def run(self, check: str, **args: Any) -> Optional[str]:
+        """Runs the check of sandbox_worker.CHECKS, returns its error, if any."""
+        with self._slots:
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+            if worker is None or not worker.alive():
+                worker = _Worker(self.python, self.app_dir)
+            try:
+                error = worker.request({"check": check, **args}, self.timeout)
+            except Exception:
+                worker.close()
+                raise
+            with self._lock:
+                self._idle.append(worker)
+        return error
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.close()
@@ -0,0 +1,80 @@
+"""Runs the checks of the generated code, in a process of the app's venv.
+
+Reads one json request per line from stdin and writes one json response per
+line, {"error": null | str}. Only depends on the standard library and on the
+app's own packages.
+
+    python sandbox_worker.py <app dir>
+"""
+
+import importlib
+import json
+import os
+import sys
+from typing import Any, Callable, Dict, List, Optional
+
+
+def _purge_app_modules() -> None:
+    """So that every check imports the code that is currently on disk."""
+    for name in list(sys.modules):
+        if name == "app" or name.startswith("app."):
+            del sys.modules[name]
+    importlib.invalidate_caches()
+
+
+def import_module(module: str) -> None:
+    importlib.import_module(module)
+
+
+def create_tables(models: List[List[str]], siblings: List[str]) -> None:
+    """Creates the tables of `models`, [module, class] pairs, in an in-memory
+    database. `siblings` are the modules of the other models, which the
+    foreign keys may refer to, imported on a best effort basis."""
+    from sqlalchemy import create_engine
+
+    for sibling in siblings:
+        try:
+            importlib.import_module(sibling)
+        except Exception:
+            pass
+    engine = create_engine("sqlite://")
+    for module, model in models:
+        model_class = getattr(importlib.import_module(module), model)
+        model_class.metadata.create_all(bind=engine)
+
+
+CHECKS: Dict[str, Callable[..., None]] = {
+    "import_module": import_module,
+    "create_tables": create_tables,
+}
+
+
+def main() -> None:
+    app_dir = sys.argv[1]
+    os.chdir(app_dir)
+    sys.path.insert(0, app_dir)
+    # Whatever the generated code prints goes to stderr, not to the responses
+    responses = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+
+    # Warm up with the packages that the checks import
+    for package in ["sqlalchemy", "fastapi", "pydantic"]:
+        try:
+            importlib.import_module(package)
+        except ImportError:
+            pass
+
+    for line in sys.stdin:
+        request: Dict[str, Any] = json.loads(line)
+        _purge_app_modules()
+        error: Optional[str] = None
+        try:
+            CHECKS[request.pop("check")](**request)
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+        responses.write(json.dumps({"error": error}) + "\n")
+        responses.flush()
+
+
+if __name__ == "__main__":
+    main()
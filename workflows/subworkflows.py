@@ -1,5 +1,11 @@
-import sys
-from typing import List, Optional
+import json
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextvars import copy_context
+from typing import List, Optional, Tuple
 
 from dotenv import load_dotenv
 from pydantic import BaseModel, ConfigDict
@@ -7,27 +13,74 @@ from pydantic import BaseModel, ConfigDict
 load_dotenv()
 
 from ai import llm
+from ai.usage import usage_scope
+from ai.validators import (
+    Cancelled,
+    MaxCodeBlocks,
+    MaxLength,
+    StreamAborted,
+    StreamValidator,
+)
+from utils.architecture import Architecture
 from workflows.helpers import (
     Function,
     ImplementedComponent,
     ModelImplementationError,
+    ModuleImportError,
     MypyError,
     REPOS,
     SQLAlchemyModel,
     create_folders_if_not_exist,
     create_tables,
     extract_from_pattern,
+    import_module,
     run_mypy,
 )
 from utils.files import File
 from utils.io import print_system
 from utils.state import Conversation
-from utils.static_analysis import RouterNotFoundError, extract_router_name
+from utils.static_analysis import (
+    MissingImportError,
+    RouterNotFoundError,
+    analyze,
+    check_imports,
+    extract_router_name,
+)
+
+CODE_RULES = """You write the python code of the components of an architecture, one at a time.
+
+Specifications:
+- The code should work (no placeholders).
+- Use appropriate typing in function arguments and return types.
+- mypy will be run over the code, so implement it in a way that it passes mypy.
+- Pick the most simple implementation.
+- Don't catch exceptions unless specified. Let errors raise."""
+
+
+def start_conversation(
+    architecture: Architecture, system: Optional[str] = None
+) -> Conversation:
+    """Starts with the parts that are the same for every component, in a
+    canonical order, so that all prompts share a byte-identical prefix that the
+    provider can cache. Component-specific messages go after them.
+    """
+    conversation = Conversation()
+    if system:
+        conversation.add_system(system)
+    conversation.add_system(CODE_RULES)
+    raw_architecture = [
+        c.dump_for_prompt() for c in sorted(architecture, key=lambda c: c.base.key)
+    ]
+    conversation.add_user(
+        "Consider the following python architecture: "
+        f"{json.dumps(raw_architecture, indent=2, sort_keys=True)}"
+    )
+    return conversation
 
 
 def save_templates(
     app_name: str,
-    architecture: List[ImplementedComponent],
+    architecture: Architecture,
     conversation: Conversation,
 ) -> None:
     for file in [".gitignore", "deploy.sh", "Dockerfile"]:
@@ -44,7 +97,7 @@ def save_templates(
         "modassembly.authentication.core.authenticate": "app/modassembly/authentication/core/authenticate.py",
         "modassembly.authentication.endpoints.login_api": "app/modassembly/authentication/endpoints/login_api.py",
     }
-    for component in architecture:
+    for component in sorted(architecture, key=lambda c: c.base.key):
         if not component.base.key in modassembly_components:
             continue
         module = component.base.key
@@ -68,6 +121,10 @@ class ImplementationContext(BaseModel):
     assistant_message: Optional[str] = None
     error: Optional[Exception] = None
     tries: int = 0
+    # Code to validate instead of generating, ie, a previous generation
+    code: Optional[str] = None
+    # Seconds that the LLM took to generate the code, without the checks
+    generation_time: float = 0.0
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
 
@@ -79,23 +136,13 @@ class CompilationError(Exception):
     pass
 
 
-def write_component(
-    app_name: str,
-    context: ImplementationContext,
-    external_infrastructure: List[str],
-    conversation: Conversation,
-) -> ImplementationContext:
-    sys.path.append(f"{REPOS}/{app_name}")
-
-    component = context.component
+def _user_message(
+    component: ImplementedComponent, external_infrastructure: List[str]
+) -> str:
+    # The shared specifications are in CODE_RULES, at the start of the conversation
     user_message = f"""Write the code for: {component.base.model_dump()}.
 
-Speficications:
-- The code should work (no placeholders).
-- Use appropriate typing in function arguments and return types.
-- mypy will be run over the code, so implement it in a way that it passes mypy.
-- Pick the most simple implementation.
-- Don't catch exceptions unless specified. Let errors raise.\n"""
+Specifications:\n"""
     if isinstance(component.base.root, Function):
         if component.base.root.is_endpoint:
             user_message += (
@@ -115,52 +162,229 @@ Speficications:
             "- Only use `ForeignKey` if the other model exists in the architecture.\n"
         )
     user_message += "\n```python\n...\n```"
-    conversation.add_user(user_message)
+    return user_message
+
+
+# Temperatures of the concurrent candidates, cycled through
+CANDIDATE_TEMPERATURES = [0.0, 0.4, 0.8, 1.0]
+# Longer responses are aborted, since a component is a single file
+MAX_RESPONSE_LENGTH = 40_000
+
+
+def _validators() -> List[StreamValidator]:
+    """Abort the responses that would fail anyway, without waiting for them."""
+    return [MaxCodeBlocks(1), MaxLength(MAX_RESPONSE_LENGTH)]
+
 
-    assistant_message = llm.stream_text(conversation)
+def _extract_code(assistant_message: str, component: ImplementedComponent) -> str:
     patterns = extract_from_pattern(assistant_message, pattern=r"```python\n(.*?)```")
-    code = None
+    if len(patterns) > 1:
+        raise MultipleCodeBlocksError(
+            f"Found {len(patterns)} code blocks.\n"
+            f"Write only the code for :: {component.base.model_dump()}"
+        )
+    return patterns[0]
+
+
+def _validate(
+    app_name: str,
+    component: ImplementedComponent,
+    code: str,
+    file_path: str,
+    environment: Optional["Future[None]"],
+    candidate: bool = False,
+) -> None:
+    """Saves the code in `file_path` and checks it, raising one of
+    CHECK_ERRORS if it fails.
+
+    A `candidate` model is only imported, since the other models that import
+    the real one would define its table twice. Its tables are checked at the
+    real path.
+    """
+    with open(f"{REPOS}/{app_name}/{file_path}", "w") as f:
+        f.write(code)
+
     try:
-        if len(patterns) > 1:
-            raise MultipleCodeBlocksError(
-                f"Found {len(patterns)} code blocks.\n"
-                f"Write only the code for :: {component.base.model_dump()}"
-            )
-        code = patterns[0]
+        # Parsed once, for the compilation and all the checks below
+        compile(analyze(code).tree, file_path, "exec")
+    except Exception as e:
+        raise CompilationError(f"Compilation error: {e}")
+    # From here on, the checks need the app's venv
+    if environment is not None:
+        environment.result()
+    check_imports(code, app_name)
+    run_mypy(app_name, f"{REPOS}/{app_name}/{file_path}")
+    module = file_path.removesuffix(".py").replace("/", ".")
+    if isinstance(component.base.root, Function):
+        if component.base.root.is_endpoint:
+            extract_router_name(code)
+        import_module(app_name, module)
+    elif isinstance(component.base.root, SQLAlchemyModel) and candidate:
+        import_module(app_name, module)
+    elif isinstance(component.base.root, SQLAlchemyModel):
+        # Which imports the module too
+        create_tables(app_name, component.base.root.namespace, code, module=module)
+
+
+CHECK_ERRORS = (
+    StreamAborted,
+    MultipleCodeBlocksError,
+    CompilationError,
+    MissingImportError,
+    MypyError,
+    RouterNotFoundError,
+    ModelImplementationError,
+    ModuleImportError,
+)
 
-        create_folders_if_not_exist(app_name, f"app.{component.base.root.namespace}")
-        folders = component.base.root.namespace.replace(".", "/")
-        file_path = f"app/{folders}/{component.base.root.name}.py"
-        with open(f"{REPOS}/{app_name}/{file_path}", "w") as f:
-            f.write(code)
 
+def _generate_candidates(
+    app_name: str,
+    component: ImplementedComponent,
+    conversation: Conversation,
+    candidates: int,
+    environment: Optional["Future[None]"],
+) -> Tuple[str, Optional[str], Optional[Exception], float]:
+    """Generates `candidates` versions of the code concurrently, each with a
+    different temperature, and checks each one in its own module.
+
+    Returns the assistant message, the code, the error and the generation
+    time of the first one that passes, or else of the one with the lowest
+    temperature. The streams of the other candidates are aborted, and they
+    aren't checked.
+    """
+    # Its own folder, since the candidates of a previous attempt may still be
+    # checked, and remove theirs when they finish
+    namespace = (
+        f"{component.base.root.namespace}."
+        f"_candidates_{component.base.root.name}_{uuid.uuid4().hex[:8]}"
+    )
+    create_folders_if_not_exist(app_name, f"app.{namespace}")
+    folder = f"app/{namespace.replace('.', '/')}"
+    selected = threading.Event()
+
+    def _candidate(i: int) -> Tuple[str, Optional[str], Optional[Exception], float]:
+        temperature = CANDIDATE_TEMPERATURES[i % len(CANDIDATE_TEMPERATURES)]
+        started = time.monotonic()
         try:
-            compile(code, "<string>", "exec")
-        except Exception as e:
-            raise CompilationError(f"Compilation error: {e}")
-        run_mypy(f"{REPOS}/{app_name}/{file_path}")
-        if (
-            isinstance(component.base.root, Function)
-            and component.base.root.is_endpoint
-        ):
-            extract_router_name(code)
-        elif isinstance(component.base.root, SQLAlchemyModel):
-            create_tables(app_name, component.base.root.namespace, code)
+            with usage_scope(component=component.base.key):
+                assistant_message = llm.stream_text(
+                    conversation,
+                    temperature=temperature,
+                    validators=[*_validators(), Cancelled(selected)],
+                )
+        except StreamAborted as e:
+            return e.text, None, e, time.monotonic() - started
+        generation_time = time.monotonic() - started
+        code = None
+        try:
+            code = _extract_code(assistant_message, component)
+            if not selected.is_set():
+                _validate(
+                    app_name,
+                    component,
+                    code,
+                    f"{folder}/c{i}.py",
+                    environment,
+                    candidate=True,
+                )
+            return assistant_message, code, None, generation_time
+        except CHECK_ERRORS as e:
+            return assistant_message, code, e, generation_time
+
+    executor = ThreadPoolExecutor(max_workers=candidates)
+    futures = [
+        executor.submit(copy_context().run, _candidate, i) for i in range(candidates)
+    ]
+    pending = [len(futures)]
+    pending_lock = threading.Lock()
+
+    def _cleanup(_: Future) -> None:
+        with pending_lock:
+            pending[0] -= 1
+            if pending[0] == 0:
+                shutil.rmtree(f"{REPOS}/{app_name}/{folder}", ignore_errors=True)
+
+    for future in futures:
+        future.add_done_callback(_cleanup)
+    try:
+        for future in as_completed(futures):
+            if future.result()[2] is None:
+                print_system(
+                    f"Selected candidate {futures.index(future)} :: {component.base.key}"
+                )
+                return future.result()
+        return futures[0].result()
+    finally:
+        selected.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def write_component(
+    app_name: str,
+    context: ImplementationContext,
+    external_infrastructure: List[str],
+    conversation: Conversation,
+    environment: Optional["Future[None]"] = None,
+    candidates: int = 1,
+) -> ImplementationContext:
+    """`environment` is the setup of the app's venv, if it's still running.
+
+    With `context.code`, only validates that code, without calling the LLM.
+    With more than one `candidates`, generates that many versions of the code
+    at the same time, and keeps the first one that passes the checks.
+    """
+    component = context.component
+    create_folders_if_not_exist(app_name, f"app.{component.base.root.namespace}")
+    folders = component.base.root.namespace.replace(".", "/")
+    file_path = f"app/{folders}/{component.base.root.name}.py"
+
+    assistant_message: Optional[str] = None
+    code = None
+    generation_time = 0.0
+    try:
+        if context.code is not None:
+            user_message = f"I wrote the code for:\n\n```python\n{context.code}\n```"
+            code = context.code
+            _validate(app_name, component, code, file_path, environment)
+        else:
+            user_message = _user_message(component, external_infrastructure)
+            conversation.add_user(user_message)
+            if candidates > 1:
+                assistant_message, code, error, generation_time = _generate_candidates(
+                    app_name, component, conversation, candidates, environment
+                )
+                if error is not None:
+                    if code is not None:
+                        with open(f"{REPOS}/{app_name}/{file_path}", "w") as f:
+                            f.write(code)
+                    raise error
+                # Checked again in its own module, ie, for mypy, the imports and the tables
+                assert code is not None
+                _validate(app_name, component, code, file_path, environment)
+            else:
+                started = time.monotonic()
+                try:
+                    with usage_scope(component=component.base.key):
+                        assistant_message = llm.stream_text(
+                            conversation, validators=_validators()
+                        )
+                finally:
+                    generation_time = time.monotonic() - started
+                code = _extract_code(assistant_message, component)
+                _validate(app_name, component, code, file_path, environment)
 
         component.file = File(path=file_path, content=code)
         return ImplementationContext(
             component=component,
             user_message=user_message,
             assistant_message=assistant_message,
+            generation_time=generation_time,
         )
-    except (
-        MultipleCodeBlocksError,
-        CompilationError,
-        MypyError,
-        RouterNotFoundError,
-        ModelImplementationError,
-    ) as e:
+    except CHECK_ERRORS as e:
         print_system(f"!!! Error: {e} for :: {component.base.root.name}")
+        if isinstance(e, StreamAborted):
+            assistant_message = e.text
         if code is not None:
             component.file = File(path=file_path, content=code)
         return ImplementationContext(
@@ -169,6 +393,5 @@ Speficications:
             assistant_message=assistant_message,
             error=e,
             tries=context.tries + 1,
+            generation_time=generation_time,
         )
-    finally:
-        sys.path.remove(f"{REPOS}/{app_name}")